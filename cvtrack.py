@@ -1,6 +1,8 @@
+import json
+import math
 import cv2
 import numpy as np
-from typing import Tuple
+from typing import Callable, Dict, List, NamedTuple, Optional, TextIO, Tuple
 
 HSV = Tuple[int, int, int]
 
@@ -14,10 +16,11 @@ def generate_thresh(low: HSV, high: HSV) -> Tuple[Tuple[HSV, HSV], Tuple[HSV, HS
     return ((low, (180, high[1], high[2])), ((0, low[1], low[2]), high))
 
 
-def thresh_img(img, thresh: Tuple[Tuple[HSV, HSV], Tuple[HSV, HSV]]):
-    bin1 = cv2.inRange(img, thresh[0][0], thresh[0][1])
-    bin2 = cv2.inRange(img, thresh[1][0], thresh[1][1])
-    binary = bin1 + bin2
+def thresh_img(img, thresh: Tuple[Tuple[HSV, HSV], Tuple[HSV, HSV]], dst: np.ndarray = None, tmp: np.ndarray = None):
+    # dst and tmp are optional preallocated buffers; the result is written into dst
+    bin1 = cv2.inRange(img, thresh[0][0], thresh[0][1], dst)
+    bin2 = cv2.inRange(img, thresh[1][0], thresh[1][1], tmp)
+    binary = np.add(bin1, bin2, out=bin1)
     return binary
 
 
@@ -28,38 +31,317 @@ def center(img):
     return x, y
 
 
-def largest_blob(img: np.ndarray, binary: np.ndarray, raise_on_fail: bool = False) -> Tuple[int, int]:
+class Detection(NamedTuple):
+    x: int
+    y: int
+    # Area of the detected blob in pixels
+    area: float
+    # How much the mask looks like a single clean blob, from 0 to 1
+    confidence: float
+
+
+def detect_contour(binary: np.ndarray) -> Optional[Detection]:
     contours, _ = cv2.findContours(binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
     if not contours:
-        if raise_on_fail:
-            cv2.imwrite("failure_img.png", img)
-            cv2.imwrite("failure_binary.png", binary)
-            raise ValueError("ERROR: Object not found! Failure images written.")
-        else:
-            return (None, None)
-    else:
-        try:
-            largest = max(contours, key=cv2.contourArea)
-            return center(largest)
-        except ZeroDivisionError as e:
-            if raise_on_fail:
-                cv2.imwrite("failure_img.png", img)
-                cv2.imwrite("failure_binary.png", binary)
-                raise ValueError("ERROR: Object not found! Failure images written.")
-            else:
-                return (None, None)
-
-
-def process_img(img, fx=None, fy=None, bob_thresh=BOB_THRESH, pivot_thresh=PIVOT_THRESH, raise_on_fail=True):
+        return None
+    areas = [cv2.contourArea(c) for c in contours]
+    i = int(np.argmax(areas))
+    try:
+        x, y = center(contours[i])
+    except ZeroDivisionError:
+        return None
+    total = sum(areas)
+    return Detection(x, y, areas[i], areas[i] / total if total else 0.0)
+
+
+def detect_components(binary: np.ndarray) -> Optional[Detection]:
+    # Labelling gives the area and centroid of every blob in a single pass
+    n, _, stats, centroids = cv2.connectedComponentsWithStats(binary, connectivity=8)
+    if n <= 1:
+        return None
+    areas = stats[1:, cv2.CC_STAT_AREA]
+    i = int(np.argmax(areas))
+    x, y = centroids[i + 1]
+    return Detection(int(x), int(y), float(areas[i]), float(areas[i] / areas.sum()))
+
+
+def detect_moments(binary: np.ndarray) -> Optional[Detection]:
+    # Treats the whole mask as one blob, so only suitable for clean masks
+    moments = cv2.moments(binary, binaryImage=True)
+    area = moments["m00"]
+    if area == 0:
+        return None
+    x = int(moments["m10"] / area)
+    y = int(moments["m01"] / area)
+    # Compare the area to that of the ellipse with the same second moments,
+    # which is close to 1 for one filled blob and small for scattered pixels
+    det = moments["mu20"] * moments["mu02"] - moments["mu11"] ** 2
+    ellipse_area = 4 * np.pi * np.sqrt(det) / area if det > 0 else 0
+    return Detection(x, y, area, min(area / ellipse_area, 1.0) if ellipse_area else 0.0)
+
+
+DETECTORS = {
+    "contour": detect_contour,
+    "components": detect_components,
+    "moments": detect_moments,
+} # type: Dict[str, Callable[[np.ndarray], Optional[Detection]]]
+
+
+def detect(img: np.ndarray, binary: np.ndarray, raise_on_fail: bool = False, detector: str = "contour") -> Optional[Detection]:
+    detection = DETECTORS[detector](binary)
+    if detection is None and raise_on_fail:
+        cv2.imwrite("failure_img.png", img)
+        cv2.imwrite("failure_binary.png", binary)
+        raise ValueError("ERROR: Object not found! Failure images written.")
+    return detection
+
+
+def largest_blob(img: np.ndarray, binary: np.ndarray, raise_on_fail: bool = False, detector: str = "contour") -> Tuple[int, int]:
+    detection = detect(img, binary, raise_on_fail, detector)
+    if detection is None:
+        return (None, None)
+    return detection.x, detection.y
+
+
+def refine(img: np.ndarray, coarse: Detection, scale: float, thresh: Tuple[HSV, HSV], detector: str = "contour", hsv_input: bool = False) -> Detection:
+    """
+    Refine a detection made on a downscaled image by thresholding a full resolution patch around it.
+    """
+    # Blob radius at full resolution, plus a few coarse pixels of slack for the coarse centroid error
+    half = int(2 * np.sqrt(coarse.area / np.pi) / scale + 3 / scale)
+    cx = int(coarse.x / scale)
+    cy = int(coarse.y / scale)
+    x0, y0 = max(cx - half, 0), max(cy - half, 0)
+    x1, y1 = min(cx + half + 1, img.shape[1]), min(cy + half + 1, img.shape[0])
+    hsv = img[y0:y1, x0:x1] if hsv_input else cv2.cvtColor(img[y0:y1, x0:x1], cv2.COLOR_BGR2HSV)
+    detection = DETECTORS[detector](thresh_img(hsv, generate_thresh(*thresh)))
+    if detection is None:
+        return Detection(cx, cy, coarse.area / scale ** 2, coarse.confidence)
+    return Detection(detection.x + x0, detection.y + y0, detection.area, detection.confidence)
+
+
+def detect_img(img, fx=None, fy=None, bob_thresh=BOB_THRESH, pivot_thresh=PIVOT_THRESH, raise_on_fail=True, detector="contour", coarse=None):
+    if coarse is not None:
+        # Find the targets on a thumbnail, then only threshold the full resolution image around them
+        small = cv2.resize(img, None, fx=coarse, fy=coarse, interpolation=cv2.INTER_AREA)
+        (bob, pivot), masks = detect_img(small, None, None, bob_thresh, pivot_thresh, raise_on_fail, detector)
+        if bob is not None:
+            bob = refine(img, bob, coarse, bob_thresh, detector)
+        if pivot is not None:
+            pivot = refine(img, pivot, coarse, pivot_thresh, detector)
+        return (bob, pivot), masks
+
     if fx is not None or fy is not None:
         img = cv2.resize(img, None, fx=fx, fy=fy)
 
     hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
     binary = thresh_img(hsv, generate_thresh(*bob_thresh))
 
-    x, y = largest_blob(img, binary, raise_on_fail)
+    bob = detect(img, binary, raise_on_fail, detector)
 
     green_binary = thresh_img(hsv, generate_thresh(*pivot_thresh))
-    pivot_x, pivot_y = largest_blob(img, green_binary, raise_on_fail)
+    pivot = detect(img, green_binary, raise_on_fail, detector)
+
+    return (bob, pivot), (binary, green_binary)
+
+
+def process_img(img, fx=None, fy=None, bob_thresh=BOB_THRESH, pivot_thresh=PIVOT_THRESH, raise_on_fail=True, detector="contour", coarse=None):
+    (bob, pivot), masks = detect_img(img, fx, fy, bob_thresh, pivot_thresh, raise_on_fail, detector, coarse)
+    x, y = (bob.x, bob.y) if bob is not None else (None, None)
+    pivot_x, pivot_y = (pivot.x, pivot.y) if pivot is not None else (None, None)
+    return ((x, y), (pivot_x, pivot_y)), masks
+
+
+class Correction:
+    """
+    Lens distortion and perspective correction for tracked positions, from tools/calibrate_camera.py.
+
+    Only the tracked points are corrected, so the cost per frame is negligible compared to undistorting whole frames.
+    """
+
+    def __init__(self, camera_matrix: np.ndarray, dist_coeffs: np.ndarray, homography: np.ndarray, size: Tuple[int, int]):
+        self.camera_matrix = camera_matrix
+        self.dist_coeffs = dist_coeffs
+        # Maps undistorted pixel positions to positions in the plane of the swing
+        self.homography = homography
+        # (width, height) of the frames used for calibration
+        self.size = size
+
+    @classmethod
+    def load(cls, path: str) -> "Correction":
+        data = np.load(path)
+        return cls(data["camera_matrix"], data["dist_coeffs"], data["homography"], tuple(int(i) for i in data["size"]))
+
+    def save(self, path: str) -> None:
+        np.savez(path, camera_matrix=self.camera_matrix, dist_coeffs=self.dist_coeffs, homography=self.homography, size=self.size)
+
+    def apply(self, points: np.ndarray, shape: Tuple[int, ...] = None) -> np.ndarray:
+        """
+        Correct an (n, 2) array of pixel positions. If shape is the shape of the (possibly resized) image the positions
+        were tracked on, they are first scaled to the calibration resolution.
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 1, 2)
+        if shape is not None:
+            points = points * (self.size[0] / shape[1], self.size[1] / shape[0])
+        undistorted = cv2.undistortPoints(points, self.camera_matrix, self.dist_coeffs, P=self.camera_matrix)
+        return cv2.perspectiveTransform(undistorted, self.homography).reshape(-1, 2)
+
+
+def angle(bob: Tuple[int, int], pivot: Tuple[int, int], correction: Optional[Correction] = None, shape: Tuple[int, ...] = None) -> float:
+    """
+    Angle of the bob from the vertical through the pivot, optionally correcting the positions first.
+    """
+    if correction is not None:
+        bob, pivot = correction.apply((bob, pivot), shape)
+    return math.atan2(bob[0] - pivot[0], bob[1] - pivot[1])
+
+
+class Target(NamedTuple):
+    name: str
+    bob_thresh: Tuple[HSV, HSV]
+    pivot_thresh: Tuple[HSV, HSV]
+    # Which blob of the threshold's colour to use, counting from the left, when several share a colour
+    bob_index: int = 0
+    pivot_index: int = 0
+
+
+def load_targets(file: TextIO) -> List[Target]:
+    """
+    Load targets from a JSON list of objects with the keys "name", "bob" and "pivot" (each a [low, high] threshold),
+    and optionally "bob_index" and "pivot_index". "count": n is shorthand for n targets using the n leftmost
+    bobs and pivots of the same colours.
+    """
+    targets = []
+    for entry in json.load(file):
+        bob = tuple(tuple(t) for t in entry["bob"])
+        pivot = tuple(tuple(t) for t in entry["pivot"])
+        if "count" in entry:
+            for i in range(entry["count"]):
+                targets.append(Target(f"{entry['name']}{i + 1}", bob, pivot, i, i))
+        else:
+            targets.append(Target(entry["name"], bob, pivot, entry.get("bob_index", 0), entry.get("pivot_index", 0)))
+    return targets
+
+
+def detect_blobs(binary: np.ndarray, n: int) -> List[Detection]:
+    """
+    Return the n largest blobs in a mask, ordered from left to right.
+    """
+    count, _, stats, centroids = cv2.connectedComponentsWithStats(binary, connectivity=8)
+    areas = stats[1:, cv2.CC_STAT_AREA]
+    total = areas.sum()
+    largest = np.argsort(areas)[::-1][:n]
+    blobs = [Detection(int(centroids[i + 1][0]), int(centroids[i + 1][1]), float(areas[i]), float(areas[i] / total)) for i in largest]
+    return sorted(blobs, key=lambda d: d.x) if count > 1 else []
+
+
+def process_targets(img, targets: List[Target], fx=None, fy=None, raise_on_fail=True, hsv_input=False):
+    """
+    Track several targets in one image. Each distinct threshold is only applied once, no matter how many targets use it.
+
+    Returns a list of ((x, y), (pivot_x, pivot_y)) in the same order as targets, with None for targets not found.
+    """
+    if fx is not None or fy is not None:
+        img = cv2.resize(img, None, fx=fx, fy=fy)
+    hsv = img if hsv_input else cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
+
+    # Number of blobs needed of each colour
+    needed = {} # type: Dict[Tuple[HSV, HSV], int]
+    for target in targets:
+        needed[target.bob_thresh] = max(needed.get(target.bob_thresh, 0), target.bob_index + 1)
+        needed[target.pivot_thresh] = max(needed.get(target.pivot_thresh, 0), target.pivot_index + 1)
+    blobs = {}
+    for thresh, n in needed.items():
+        binary = thresh_img(hsv, generate_thresh(*thresh))
+        blobs[thresh] = detect_blobs(binary, n)
+        if len(blobs[thresh]) < n and raise_on_fail:
+            cv2.imwrite("failure_img.png", img)
+            cv2.imwrite("failure_binary.png", binary)
+            raise ValueError(f"ERROR: Only found {len(blobs[thresh])} of {n} objects for threshold {thresh}! Failure images written.")
+
+    results = []
+    for target in targets:
+        bobs = blobs[target.bob_thresh]
+        pivots = blobs[target.pivot_thresh]
+        bob = bobs[target.bob_index] if target.bob_index < len(bobs) else None
+        pivot = pivots[target.pivot_index] if target.pivot_index < len(pivots) else None
+        results.append(((bob.x, bob.y) if bob is not None else None, (pivot.x, pivot.y) if pivot is not None else None))
+    return results
+
+
+class Tracker:
+    """
+    Tracks frames like process_img, but reuses the frame, HSV and mask buffers between calls
+    instead of allocating new ones for every frame.
+
+    The returned masks are the internal buffers and are overwritten by the next frame.
+    If hsv_input is set, frames are expected to already be in HSV (e.g. from an HSV frame cache).
+    """
+
+    def __init__(self, fx=None, fy=None, bob_thresh=BOB_THRESH, pivot_thresh=PIVOT_THRESH, raise_on_fail=True, detector="contour",
+                 coarse=None, keep_masks=False, hsv_input=False):
+        self.fx = fx
+        self.fy = fy
+        self.bob_thresh = bob_thresh
+        self.pivot_thresh = pivot_thresh
+        self.raise_on_fail = raise_on_fail
+        self.detector = detector
+        self.coarse = coarse
+        self.keep_masks = keep_masks
+        self.hsv_input = hsv_input
+        # Generated once since the thresholds don't change
+        self._bob_ranges = generate_thresh(*bob_thresh)
+        self._pivot_ranges = generate_thresh(*pivot_thresh)
+        self.frame = None # type: np.ndarray
+        self.image = None # type: np.ndarray
+        self.detections = (None, None) # type: Tuple[Optional[Detection], Optional[Detection]]
+        self._resized = None # type: np.ndarray
+        self._hsv = None # type: np.ndarray
+        self._masks = [None, None, None] # type: List[np.ndarray]
+
+    def read(self, cap: cv2.VideoCapture) -> bool:
+        """
+        Decode the next frame of cap into the frame buffer.
+        """
+        success, frame = cap.read(self.frame)
+        if success:
+            self.frame = frame
+        return success
+
+    def process(self, img: np.ndarray = None):
+        """
+        Track img, or the last frame read if img is None. Returns the same values as process_img,
+        except the masks are None unless keep_masks is set.
+        """
+        if img is None:
+            img = self.frame
+        scale = self.coarse
+        if scale is not None:
+            self._resized = cv2.resize(img, None, self._resized, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+            small = self._resized
+        elif self.fx is not None or self.fy is not None:
+            self._resized = cv2.resize(img, None, self._resized, fx=self.fx, fy=self.fy)
+            small = img = self._resized
+        else:
+            small = img
+        self.image = img
+
+        if self.hsv_input:
+            self._hsv = small
+        else:
+            self._hsv = cv2.cvtColor(small, cv2.COLOR_BGR2HSV, self._hsv)
+        binary = self._masks[0] = thresh_img(self._hsv, self._bob_ranges, self._masks[0], self._masks[2])
+        bob = detect(small, binary, self.raise_on_fail, self.detector)
+        green_binary = self._masks[1] = thresh_img(self._hsv, self._pivot_ranges, self._masks[1], self._masks[2])
+        pivot = detect(small, green_binary, self.raise_on_fail, self.detector)
+        if scale is not None:
+            if bob is not None:
+                bob = refine(img, bob, scale, self.bob_thresh, self.detector, self.hsv_input)
+            if pivot is not None:
+                pivot = refine(img, pivot, scale, self.pivot_thresh, self.detector, self.hsv_input)
+        self.detections = (bob, pivot)
 
-    return ((x, y), (pivot_x, pivot_y)), (binary, green_binary)
\ No newline at end of file
+        x, y = (bob.x, bob.y) if bob is not None else (None, None)
+        pivot_x, pivot_y = (pivot.x, pivot.y) if pivot is not None else (None, None)
+        masks = (binary, green_binary) if self.keep_masks else None
+        return ((x, y), (pivot_x, pivot_y)), masks
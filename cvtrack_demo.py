@@ -1,54 +1,146 @@
 import sys
+import time
 from typing import Optional
 import cv2
+import numpy as np
 import argparse
 import cvtrack
+import framecache
 
-def main(vid_name: str, start_time: int, frame_delay: Optional[int], fx: Optional[float], fy: Optional[float]):
+# Seconds to jump when seeking with [ and ]
+SEEK_STEP = 5
+# When playback falls more than this many seconds behind, seek instead of grabbing frames to catch up
+MAX_CATCHUP = 2
+
+
+def _drawable(img: np.ndarray) -> np.ndarray:
+    # Frames from the frame cache are read-only views into it, so draw on a copy
+    return img if img.flags.writeable else img.copy()
+
+
+def show_frame(vid_name: str, tracker: cvtrack.Tracker, frame_no: int, fps: float, track: bool, stats: dict) -> None:
+    if track:
+        start = time.perf_counter()
+        ((x, y), (pivot_x, pivot_y)), (binary, green_binary) = tracker.process()
+        stats["latency"] = (time.perf_counter() - start) * 1000
+        # The frame the coordinates refer to, which is resized if fx or fy are set
+        img = _drawable(tracker.image)
+        if x is not None:
+            cv2.circle(img, (x, y), 3, (0, 255, 0), thickness=cv2.FILLED)
+        if pivot_x is not None:
+            cv2.circle(img, (pivot_x, pivot_y), 3, (0, 0, 255), thickness=cv2.FILLED)
+        cv2.imshow("binary", binary)
+        cv2.imshow("pivot binary", green_binary)
+    else:
+        img = tracker.frame
+        if tracker.fx is not None or tracker.fy is not None:
+            img = cv2.resize(img, None, fx=tracker.fx, fy=tracker.fy)
+        img = _drawable(img)
+        stats["skipped"] += 1
+
+    now = time.perf_counter()
+    if stats["last_shown"] is not None:
+        dt = now - stats["last_shown"]
+        if dt > 0:
+            # Exponential moving average so the readout doesn't flicker
+            stats["fps"] = 0.9 * stats["fps"] + 0.1 / dt if stats["fps"] else 1 / dt
+    stats["last_shown"] = now
+
+    lines = [
+        f"t={frame_no / fps:.3f}s frame={frame_no} speed={stats['speed']}x",
+        f"tracking {stats['latency']:.1f}ms, {stats['fps']:.1f}fps, {stats['skipped']} untracked",
+    ]
+    for i, line in enumerate(lines):
+        cv2.putText(img, line, (10, 20 + 20 * i), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1, cv2.LINE_AA)
+    cv2.imshow(vid_name, img)
+
+
+def main(vid_name: str, start_time: int, frame_delay: Optional[int], fx: Optional[float], fy: Optional[float], speed: float, detector: str, coarse: Optional[float], index: Optional[bool],
+         cache: bool, cache_scale: Optional[float]):
     pause = True
 
-    cap = cv2.VideoCapture(vid_name)
-    wait_time = int(1000 / cap.get(cv2.CAP_PROP_FPS)) if frame_delay is None else frame_delay
+    cap = framecache.open_video(vid_name, cache, cache_scale, use_index=index)
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    # Rate at which the video clock advances during playback
+    play_fps = fps * speed if frame_delay is None else 1000 / frame_delay
 
     if start_time:
         cap.set(cv2.CAP_PROP_POS_MSEC, start_time)
 
-    success, img = cap.read()
-    if not success:
+    stats = {"latency": 0.0, "fps": 0.0, "skipped": 0, "last_shown": None, "speed": speed}
+    tracker = cvtrack.Tracker(fx=fx, fy=fy, raise_on_fail=False, detector=detector, coarse=coarse, keep_masks=True)
+    frame_no = int(cap.get(cv2.CAP_PROP_POS_FRAMES))
+    if not tracker.read(cap):
         sys.exit(1)
+    show_frame(vid_name, tracker, frame_no, fps, True, stats)
 
-    ((x, y), (pivot_x, pivot_y)), (binary, green_binary) = cvtrack.process_img(img, fx=fx, fy=fy)
-    if fx is not None and fy is not None:
-        img = cv2.resize(img, None, fx=fx, fy=fy)
-    cv2.circle(img, (x, y), 3, (0, 255, 0), thickness=cv2.FILLED)
-    cv2.circle(img, (pivot_x, pivot_y), 3, (0, 0, 255), thickness=cv2.FILLED)
-
-    cv2.imshow(vid_name, img)
-    cv2.imshow("binary", binary)
-    cv2.imshow("pivot binary", green_binary)
+    def seek(target: int) -> bool:
+        nonlocal frame_no
+        cap.set(cv2.CAP_PROP_POS_FRAMES, max(target, 0))
+        frame_no = int(cap.get(cv2.CAP_PROP_POS_FRAMES))
+        success = tracker.read(cap)
+        if success:
+            show_frame(vid_name, tracker, frame_no, fps, True, stats)
+        return success
 
+    # Wall clock time at which the current frame was due
+    anchor = time.perf_counter()
+    anchor_frame = frame_no
     while True:
-        key = cv2.waitKey(wait_time)
+        if pause:
+            key = cv2.waitKey(50)
+        else:
+            due = anchor + (frame_no + 1 - anchor_frame) / play_fps
+            key = cv2.waitKey(max(1, int((due - time.perf_counter()) * 1000)))
         if key == ord('q'):
             break
         elif key == ord(' '):
             pause = not pause
+        elif key == ord('.'):
+            pause = True
+            if not seek(frame_no + 1):
+                break
+        elif key == ord(','):
+            pause = True
+            seek(frame_no - 1)
+        elif key == ord(']'):
+            if not seek(frame_no + int(SEEK_STEP * fps)):
+                break
+        elif key == ord('['):
+            seek(frame_no - int(SEEK_STEP * fps))
+        elif key in (ord('+'), ord('=')) and frame_delay is None:
+            stats["speed"] *= 2
+            play_fps *= 2
+        elif key == ord('-') and frame_delay is None:
+            stats["speed"] /= 2
+            play_fps /= 2
+        if key != -1:
+            # Restart the video clock from the current frame after any interaction
+            anchor = time.perf_counter()
+            anchor_frame = frame_no
 
         if pause:
             continue
 
-        success, img = cap.read()
-        if not success:
-            break
-        ((x, y), (pivot_x, pivot_y)), (binary, green_binary) = cvtrack.process_img(img, fx=fx, fy=fy)
-        if fx is not None and fy is not None:
-            img = cv2.resize(img, None, fx=fx, fy=fy)
-        cv2.circle(img, (x, y), 3, (0, 255, 0), thickness=cv2.FILLED)
-        cv2.circle(img, (pivot_x, pivot_y), 3, (0, 0, 255), thickness=cv2.FILLED)
+        # Work out which frame should be on screen now, and drop any we are behind on
+        target = anchor_frame + int((time.perf_counter() - anchor) * play_fps)
+        behind = target - frame_no - 1
+        if behind > MAX_CATCHUP * fps:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, target)
+            frame_no = target - 1
+            stats["skipped"] += behind
+        elif behind > 0:
+            for _ in range(behind):
+                cap.grab()
+            frame_no += behind
+            stats["skipped"] += behind
 
-        cv2.imshow(vid_name, img)
-        cv2.imshow("binary", binary)
-        cv2.imshow("pivot binary", green_binary)
+        if not tracker.read(cap):
+            break
+        frame_no += 1
+        # Frames that are already late by the time they are decoded are displayed without tracking
+        late = time.perf_counter() > anchor + (frame_no + 1 - anchor_frame) / play_fps
+        show_frame(vid_name, tracker, frame_no, fps, not late, stats)
     cap.release()
     try:
         cv2.destroyAllWindows()
@@ -57,10 +149,17 @@ def main(vid_name: str, start_time: int, frame_delay: Optional[int], fx: Optiona
 
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Visual tracker demo.")
+    parser = argparse.ArgumentParser(description="Visual tracker demo. Controls: space to play/pause, . and , to step one frame, "
+                                                 "[ and ] to seek, + and - to change speed, q to quit.")
     parser.add_argument("vid_name", type=str)
     parser.add_argument("start_time", type=int, default=0, nargs="?")
-    parser.add_argument("--frame-delay", type=int, default=None)
+    parser.add_argument("--frame-delay", type=int, default=None, help="Fixed delay between frames in ms instead of following the video clock.")
     parser.add_argument("--fx", type=float, default=None)
     parser.add_argument("--fy", type=float, default=None)
+    parser.add_argument("--index", action="store_const", const=True, default=None, help="Seek and take timestamps from a frame index, building it if needed. By default an existing index is used.")
+    parser.add_argument("--cache", action="store_true", help="Read frames from the memory-mapped frame cache, decoding the video into it on first use.")
+    parser.add_argument("--cache-scale", type=float, default=None, help="Downscale factor of the cached frames.")
+    parser.add_argument("--detector", choices=cvtrack.DETECTORS.keys(), default="contour")
+    parser.add_argument("--coarse", type=float, default=None, help="Find targets on a frame downscaled by this factor, then refine at full resolution")
+    parser.add_argument("--speed", type=float, default=1.0, help="Playback speed relative to real time.")
     main(**vars(parser.parse_args()))
@@ -0,0 +1,257 @@
+"""
+Memory-mapped cache of decoded video frames.
+
+Decoding a long H.264 video is often the most expensive part of a pass over it. The first time a video is opened
+through the cache, every frame is decoded (optionally downscaled and/or converted to HSV) into a raw uint8 array on
+local disk. Later passes map that file and read frames from it with random access and no decoding or copying.
+
+The cache directory is bounded in size, evicting the least recently used videos first.
+"""
+import argparse
+import hashlib
+import json
+import os
+import pathlib
+import time
+from typing import List, Optional, Union
+
+import cv2
+import numpy as np
+
+import vidindex
+
+CACHE_DIR = pathlib.Path(os.environ.get("PHY180_FRAME_CACHE", "~/.cache/phy180_frames")).expanduser()
+# Maximum total size of the cache in GiB
+CACHE_LIMIT = float(os.environ.get("PHY180_FRAME_CACHE_LIMIT", 32))
+# Frame files without metadata which haven't been written to for this many seconds are left from interrupted builds
+STALE_BUILD = 60
+
+
+class CacheTooLarge(ValueError):
+    """
+    A video does not fit in the cache even when it is empty.
+    """
+
+
+def cache_key(video: pathlib.Path, scale: Optional[float], hsv: bool) -> str:
+    stat = video.stat()
+    desc = f"{video.resolve()}|{stat.st_size}|{stat.st_mtime}|{scale}|{hsv}"
+    return hashlib.sha1(desc.encode("utf-8")).hexdigest()
+
+
+def cache_entries(cache_dir: pathlib.Path) -> List[pathlib.Path]:
+    """
+    Return the metadata files of complete cache entries, least recently used first.
+    """
+    if not cache_dir.exists():
+        return []
+    return sorted(cache_dir.glob("*.json"), key=lambda p: p.stat().st_mtime)
+
+
+def evict(cache_dir: pathlib.Path, limit: int, needed: int = 0, keep: str = None) -> None:
+    """
+    Delete frame files left by interrupted builds, then least recently used entries until there is room for needed
+    more bytes. Builds in progress (keep, or other files still being written) are counted but not deleted.
+    """
+    if needed > limit:
+        raise CacheTooLarge(f"{needed / 2 ** 30:.3g} GiB of frames is more than the cache limit of {limit / 2 ** 30:.3g} GiB")
+    entries = [(p, p.with_suffix(".frames")) for p in cache_entries(cache_dir) if p.stem != keep]
+    total = sum(d.stat().st_size for _, d in entries if d.exists())
+    now = time.time()
+    for data in cache_dir.glob("*.frames") if cache_dir.exists() else []:
+        if data.with_suffix(".json").exists():
+            continue
+        stat = data.stat()
+        if data.stem != keep and now - stat.st_mtime > STALE_BUILD:
+            data.unlink()
+        elif data.stem != keep:
+            total += stat.st_size
+    for meta, data in entries:
+        if total + needed <= limit:
+            break
+        if data.exists():
+            total -= data.stat().st_size
+            data.unlink()
+        meta.unlink()
+
+
+class FrameCache:
+
+    def __init__(self, video: Union[str, pathlib.Path], scale: Optional[float] = None, hsv: bool = False,
+                 cache_dir: pathlib.Path = CACHE_DIR, limit: float = CACHE_LIMIT):
+        self.video = pathlib.Path(video)
+        self.scale = scale
+        self.hsv = hsv
+        self.cache_dir = cache_dir
+        self.limit = int(limit * 2 ** 30)
+        key = cache_key(self.video, scale, hsv)
+        self.meta_path = cache_dir / (key + ".json")
+        self.data_path = cache_dir / (key + ".frames")
+        if not self.meta_path.exists():
+            self._build()
+        with self.meta_path.open(encoding="utf-8") as f:
+            meta = json.load(f)
+        # Mark as recently used for eviction
+        os.utime(self.meta_path)
+        self.fps = meta["fps"]
+        self.times = np.array(meta["times"])
+        # Read-only, since every page written to in a copy-on-write map stays in private memory until it is closed;
+        # callers which draw on frames copy them first
+        self.frames = np.memmap(self.data_path, dtype=np.uint8, mode="r", shape=tuple(meta["shape"]))
+
+    def __len__(self) -> int:
+        return len(self.frames)
+
+    def _convert(self, img: np.ndarray) -> np.ndarray:
+        if self.scale is not None:
+            img = cv2.resize(img, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        if self.hsv:
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
+        return img
+
+    def _build(self) -> None:
+        cap = vidindex.open_video(self.video)
+        if not cap.isOpened():
+            raise ValueError(f"Cannot open video {self.video}")
+        fps = cap.get(cv2.CAP_PROP_FPS) or 30
+        count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        success, img = cap.read()
+        if not success:
+            raise ValueError(f"Cannot read video {self.video}")
+        shape = self._convert(img).shape
+        frame_size = int(np.prod(shape))
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        try:
+            evict(self.cache_dir, self.limit, count * frame_size, keep=self.meta_path.stem)
+        except CacheTooLarge:
+            cap.release()
+            raise
+
+        times = []
+        with self.data_path.open("wb") as f:
+            while success:
+                # The frame count from the container is only an estimate
+                if (len(times) + 1) * frame_size > self.limit:
+                    break
+                ms = cap.get(cv2.CAP_PROP_POS_MSEC)
+                # Same fix as vidindex for zero timestamps at the end of some videos
+                if times and ms == 0:
+                    ms = times[-1] + 1000 / fps
+                times.append(ms)
+                f.write(np.ascontiguousarray(self._convert(img)).data)
+                success, img = cap.read(img)
+        cap.release()
+        if success:
+            self.data_path.unlink()
+            raise CacheTooLarge(f"{self.video} has more frames than fit in the cache limit of {self.limit / 2 ** 30:.3g} GiB")
+        # The metadata is written last so an interrupted build is never mistaken for a complete one
+        meta = {"video": str(self.video.resolve()), "fps": fps, "shape": [len(times), *shape], "times": times}
+        tmp = self.meta_path.with_suffix(".tmp")
+        with tmp.open("w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(tmp, self.meta_path)
+
+
+class CachedCapture:
+    """
+    Drop-in replacement for cv2.VideoCapture that reads frames from a FrameCache.
+
+    Frames are returned as read-only views into the memory map rather than copied.
+    """
+
+    def __init__(self, cache: FrameCache):
+        self.cache = cache
+        self.next_frame = 0
+
+    def isOpened(self) -> bool: # pylint: disable=invalid-name
+        return True
+
+    def release(self) -> None:
+        pass
+
+    def grab(self) -> bool:
+        if self.next_frame >= len(self.cache):
+            return False
+        self.next_frame += 1
+        return True
+
+    def retrieve(self, image: np.ndarray = None): # pylint: disable=unused-argument
+        if not 0 < self.next_frame <= len(self.cache):
+            return False, None
+        return True, self.cache.frames[self.next_frame - 1]
+
+    def read(self, image: np.ndarray = None):
+        if not self.grab():
+            return False, None
+        return self.retrieve(image)
+
+    def get(self, prop: int) -> float:
+        if prop == cv2.CAP_PROP_POS_MSEC:
+            return float(self.cache.times[self.next_frame - 1]) if self.next_frame > 0 else 0.0
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            return float(self.next_frame)
+        if prop == cv2.CAP_PROP_FRAME_COUNT:
+            return float(len(self.cache))
+        if prop == cv2.CAP_PROP_FPS:
+            return self.cache.fps
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return float(self.cache.frames.shape[2])
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return float(self.cache.frames.shape[1])
+        return 0.0
+
+    def set(self, prop: int, value: float) -> bool:
+        if prop == cv2.CAP_PROP_POS_MSEC:
+            self.next_frame = int(np.searchsorted(self.cache.times, value - 1e-3))
+        elif prop == cv2.CAP_PROP_POS_FRAMES:
+            self.next_frame = int(value)
+        else:
+            return False
+        self.next_frame = min(max(self.next_frame, 0), len(self.cache))
+        return True
+
+
+def open_video(video: Union[str, pathlib.Path], use_cache: bool = False, scale: Optional[float] = None, hsv: bool = False,
+               use_index: Optional[bool] = None):
+    """
+    Open a video through the frame cache if use_cache is set (decoding it into the cache on first use),
+    otherwise open it with vidindex.open_video.
+    """
+    if use_cache and pathlib.Path(video).exists():
+        try:
+            return CachedCapture(FrameCache(video, scale, hsv))
+        except CacheTooLarge as e:
+            print(f"Not caching {video}: {e}")
+    return vidindex.open_video(video, use_index)
+
+
+def is_hsv(cap) -> bool:
+    """
+    Whether the frames of a capture from open_video are HSV, which is only the case for an HSV cache (open_video
+    falls back to reading the video directly if it can't be cached).
+    """
+    return isinstance(cap, CachedCapture) and cap.cache.hsv
+
+
+def main(videos: List[pathlib.Path], scale: Optional[float], hsv: bool, list_entries: bool, clear: bool) -> None:
+    if clear:
+        evict(CACHE_DIR, 0)
+    for video in videos:
+        cache = FrameCache(video, scale, hsv)
+        print(f"{video}: {len(cache)} frames of {cache.frames.shape[2]}x{cache.frames.shape[1]} cached")
+    if list_entries:
+        for meta_path in reversed(cache_entries(CACHE_DIR)):
+            with meta_path.open(encoding="utf-8") as f:
+                meta = json.load(f)
+            size = meta_path.with_suffix(".frames").stat().st_size / 2 ** 30
+            print(f"{meta['video']}\t{meta['shape']}\t{size:.2f} GiB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=f"Decode videos into the frame cache at {CACHE_DIR}")
+    parser.add_argument("videos", type=pathlib.Path, nargs="*")
+    parser.add_argument("--scale", type=float, default=None, help="Downscale cached frames by this factor")
+    parser.add_argument("--hsv", action="store_true", help="Store frames converted to HSV")
+    parser.add_argument("--list", dest="list_entries", action="store_true", help="List cached videos, most recently used first")
+    parser.add_argument("--clear", action="store_true", help="Delete everything in the cache")
+    main(**vars(parser.parse_args()))
@@ -1,22 +1,164 @@
-from typing import Optional, TextIO
+import resident
+# Run on the resident worker instead if one is running (see worker.py)
+resident.forward(__name__)
+from collections import deque
+from typing import Callable, Iterator, List, Optional, TextIO, Tuple
 import cv2
-import math
 import argparse
+import math
 import cvtrack
+import framecache
+import scan_motion
+import shmtrack
+
+def track(cap: cv2.VideoCapture, tracker: cvtrack.Tracker, skip_frames: int, correction: Optional[cvtrack.Correction] = None) -> Iterator[Tuple[float, float]]:
+    while tracker.read(cap):
+        bob, pivot = tracker.process()[0]
+        yield cap.get(cv2.CAP_PROP_POS_MSEC) / 1000, cvtrack.angle(bob, pivot, correction, tracker.image.shape)
+        for _ in range(skip_frames):
+            cap.grab()
+
+
+def track_targets(cap: cv2.VideoCapture, tracker: cvtrack.Tracker, targets: List[cvtrack.Target], skip_frames: int,
+                  correction: Optional[cvtrack.Correction] = None) -> Iterator[Tuple[float, List[float]]]:
+    while tracker.read(cap):
+        positions = cvtrack.process_targets(tracker.frame, targets, tracker.fx, tracker.fy, hsv_input=tracker.hsv_input)
+        # process_targets resizes internally, so work out the shape the positions refer to
+        shape = (tracker.frame.shape[0] * (tracker.fy or 1), tracker.frame.shape[1] * (tracker.fx or 1))
+        yield cap.get(cv2.CAP_PROP_POS_MSEC) / 1000, [cvtrack.angle(bob, pivot, correction, shape) for bob, pivot in positions]
+        for _ in range(skip_frames):
+            cap.grab()
+
+
+class PhasePredictor:
+    """
+    Predicts the phase of the swing from the recent turning points, with 0 at a maximum, pi/2 at the following
+    zero crossing and pi at a minimum.
+    """
+
+    def __init__(self):
+        self.last = None # type: Optional[Tuple[float, float]]
+        # Time the angle stopped changing, if the last few samples are equal
+        self.flat_since = None # type: Optional[float]
+        self.rising = None # type: Optional[bool]
+        # (time, angle, is maximum) of the last three turning points
+        self.turns = deque(maxlen=3)
 
-def main(vid_name: str, out_file: TextIO, skip_frames: int, start_time: int, fx: Optional[float], fy: Optional[float]):
-    cap = cv2.VideoCapture(vid_name)
+    def add(self, t: float, theta: float) -> None:
+        if self.last is not None:
+            t_last, a_last = self.last
+            if theta == a_last:
+                if self.flat_since is None:
+                    self.flat_since = t_last
+            else:
+                rising = theta > a_last
+                if self.rising is not None and rising != self.rising:
+                    # Turning point at the last sample, or the middle of a flat top
+                    start = self.flat_since if self.flat_since is not None else t_last
+                    self._turn((start + t_last) / 2, a_last, self.rising)
+                self.rising = rising
+                self.flat_since = None
+        self.last = (t, theta)
+
+    def _turn(self, t: float, theta: float, is_max: bool) -> None:
+        if self.turns and self.turns[-1][2] == is_max:
+            # Tracking noise around the same turning point; keep the most extreme sample
+            if (theta > self.turns[-1][1]) == is_max:
+                self.turns[-1] = (t, theta, is_max)
+            return
+        if len(self.turns) >= 2 and abs(theta - self.turns[-1][1]) < 0.5 * abs(self.turns[-1][1] - self.turns[-2][1]):
+            # Too small to be the next half-swing
+            return
+        self.turns.append((t, theta, is_max))
+
+    def phase(self, t: float) -> Optional[float]:
+        """
+        Predicted phase at time t, or None until enough of the swing has been seen or if the prediction is stale.
+        """
+        if len(self.turns) < 3:
+            return None
+        half_period = (self.turns[2][0] - self.turns[0][0]) / 2
+        t_last, _, is_max = self.turns[-1]
+        if half_period <= 0 or t - t_last > 1.5 * half_period:
+            return None
+        return (0 if is_max else math.pi) + math.pi * (t - t_last) / half_period
+
+
+def track_adaptive(cap: cv2.VideoCapture, tracker: cvtrack.Tracker, skip_frames: int, window: float,
+                   correction: Optional[cvtrack.Correction] = None) -> Iterator[Tuple[float, float, bool]]:
+    """
+    Track every frame while the predicted phase is within window of a turning point or zero crossing (or while the
+    phase is unknown), and every (skip_frames + 1)th frame otherwise. Yields the time, angle and whether the sample
+    was taken densely.
+    """
+    predictor = PhasePredictor()
+    frame_time = 1 / (cap.get(cv2.CAP_PROP_FPS) or 30)
+    quarter = math.pi / 2
+    while tracker.read(cap):
+        bob, pivot = tracker.process()[0]
+        t = cap.get(cv2.CAP_PROP_POS_MSEC) / 1000
+        theta = cvtrack.angle(bob, pivot, correction, tracker.image.shape)
+        predictor.add(t, theta)
+        # Skip only if no turning point or zero crossing (multiples of pi/2) comes near before the next tracked frame
+        now = predictor.phase(t)
+        end = predictor.phase(t + (skip_frames + 1) * frame_time)
+        dense = now is None or end is None or math.ceil((now - window) / quarter) * quarter - window <= end
+        yield t, theta, dense
+        if not dense:
+            for _ in range(skip_frames):
+                cap.grab()
+
+
+def track_segments(cap: cv2.VideoCapture, segments: List[Tuple[float, float]], track_fn: Callable[[], Iterator[tuple]]) -> Iterator[tuple]:
+    """
+    Run a tracking generator from the start of each (start, stop) segment in ms until it passes the stop time,
+    skipping everything in between.
+    """
+    for start, stop in segments:
+        cap.set(cv2.CAP_PROP_POS_MSEC, start)
+        for sample in track_fn():
+            if sample[0] * 1000 > stop:
+                break
+            yield sample
+
+
+def main(vid_name: str, out_file: TextIO, skip_frames: int, start_time: int, fx: Optional[float], fy: Optional[float], detector: str, coarse: Optional[float], index: Optional[bool],
+         cache: bool, cache_scale: Optional[float], cache_hsv: bool, workers: int,
+         targets: Optional[TextIO], correction: Optional[str], adaptive: bool, adaptive_window: float,
+         segments: Optional[TextIO]):
+    cap = framecache.open_video(vid_name, cache, cache_scale, cache_hsv, index)
     if start_time:
         cap.set(cv2.CAP_PROP_POS_MSEC, start_time)
+    if segments is not None:
+        # Only the parts of the segments after the start time are tracked
+        segment_list = [(max(start, start_time), stop) for start, stop in scan_motion.load_segments(segments) if stop > start_time]
+        segments.close()
 
-    while True:
-        success, img = cap.read()
-        if not success:
-            print("Finished")
-            break
-        ((x, y), (pivot_x, pivot_y)), _ = cvtrack.process_img(img, fx=fx, fy=fy)
-        angle = math.atan2(x - pivot_x, y - pivot_y)
-        time = cap.get(cv2.CAP_PROP_POS_MSEC) / 1000
+    correction = cvtrack.Correction.load(correction) if correction is not None else None
+    tracker_args = dict(fx=fx, fy=fy, detector=detector, coarse=coarse, hsv_input=framecache.is_hsv(cap))
+    if targets is not None:
+        # One angle column per target, labelled in a comment so the file still loads as time vs first angle
+        target_list = cvtrack.load_targets(targets)
+        out_file.write("# time " + " ".join(t.name for t in target_list) + "\n")
+        tracker = cvtrack.Tracker(**tracker_args)
+        gen = lambda: track_targets(cap, tracker, target_list, skip_frames, correction)
+        samples = ((time, " ".join(str(a) for a in angles)) for time, angles in
+                   (track_segments(cap, segment_list, gen) if segments is not None else gen()))
+    elif adaptive:
+        # The third column is 1 for frames tracked densely near a turning point or zero crossing, 0 for sparse ones
+        out_file.write("# time angle dense\n")
+        tracker = cvtrack.Tracker(**tracker_args)
+        gen = lambda: track_adaptive(cap, tracker, skip_frames, math.radians(adaptive_window), correction)
+        samples = ((time, f"{angle} {int(dense)}") for time, angle, dense in
+                   (track_segments(cap, segment_list, gen) if segments is not None else gen()))
+    elif workers > 1:
+        samples = shmtrack.track_parallel(cap, workers, skip_frames=skip_frames, correction=correction, **tracker_args)
+    elif segments is not None:
+        tracker = cvtrack.Tracker(**tracker_args)
+        samples = track_segments(cap, segment_list, lambda: track(cap, tracker, skip_frames, correction))
+    else:
+        samples = track(cap, cvtrack.Tracker(**tracker_args), skip_frames, correction)
+    for time, angle in samples:
         # At the end of the video the time is zero for some reason
         # This only happens for a few frame so we'll just skip them
         if time != 0:
@@ -24,8 +166,7 @@ def main(vid_name: str, out_file: TextIO, skip_frames: int, start_time: int, fx:
             print(time, "\t", angle, sep="")
         else:
             print("Skipped a frame")
-        for _ in range(skip_frames):
-            cap.read()
+    print("Finished")
 
     out_file.close()
 
@@ -38,4 +179,23 @@ if __name__ == "__main__":
     parser.add_argument("--skip-frames", type=int, default=3)
     parser.add_argument("--fx", type=float, default=None)
     parser.add_argument("--fy", type=float, default=None)
-    main(**vars(parser.parse_args()))
+    parser.add_argument("--index", action="store_const", const=True, default=None, help="Seek and take timestamps from a frame index, building it if needed. By default an existing index is used.")
+    parser.add_argument("--cache", action="store_true", help="Read frames from the memory-mapped frame cache, decoding the video into it on first use.")
+    parser.add_argument("--cache-scale", type=float, default=None, help="Downscale factor of the cached frames.")
+    parser.add_argument("--cache-hsv", action="store_true", help="Cache frames already converted to HSV.")
+    parser.add_argument("--workers", "-j", type=int, default=1, help="Number of tracker processes fed from one decoder through shared memory.")
+    parser.add_argument("--detector", choices=cvtrack.DETECTORS.keys(), default="contour")
+    parser.add_argument("--coarse", type=float, default=None, help="Find targets on a frame downscaled by this factor, then refine at full resolution")
+    parser.add_argument("--targets", type=argparse.FileType("r", encoding="utf-8"), default=None, help="JSON file of several targets to track at once (see cvtrack.load_targets); writes one angle column per target.")
+    parser.add_argument("--correction", type=str, default=None, help="Lens and perspective correction file from tools/calibrate_camera.py.")
+    parser.add_argument("--adaptive", action="store_true", help="Track every frame near turning points and zero crossings of the swing and only every (skip frames + 1)th frame elsewhere, adding a column of 1 (dense) or 0 (sparse).")
+    parser.add_argument("--adaptive-window", type=float, default=20, help="Phase window around turning points and zero crossings for --adaptive, in degrees of the swing.")
+    parser.add_argument("--segments", type=argparse.FileType("r", encoding="utf-8"), default=None, help="Times file (e.g. from scan_motion.py) of the segments to track; footage outside them is skipped.")
+    args = parser.parse_args()
+    if args.segments is not None and args.workers > 1:
+        parser.error("--segments cannot be combined with --workers")
+    if args.adaptive and (args.workers > 1 or args.targets is not None):
+        parser.error("--adaptive cannot be combined with --workers or --targets")
+    if args.targets is not None and (args.workers > 1 or args.coarse is not None or args.detector != "contour"):
+        parser.error("--targets cannot be combined with --workers, --coarse or --detector")
+    main(**vars(args))
@@ -0,0 +1,180 @@
+import argparse
+import glob
+import json
+import math
+import multiprocessing
+import os
+import pathlib
+import time
+from typing import List, Optional
+
+import cv2
+import cvtrack
+import vidindex
+
+VIDEO_EXTENSIONS = (".mp4", ".mov", ".avi", ".mkv", ".m4v")
+
+
+def find_videos(inputs: List[str]) -> List[pathlib.Path]:
+    videos = []
+    for pattern in inputs:
+        path = pathlib.Path(pattern)
+        if path.is_dir():
+            videos.extend(sorted(p for p in path.iterdir() if p.suffix.lower() in VIDEO_EXTENSIONS))
+        else:
+            videos.extend(sorted(pathlib.Path(p) for p in glob.glob(pattern)))
+    return videos
+
+
+def load_checkpoint(path: pathlib.Path) -> dict:
+    if path.exists():
+        with path.open(encoding="utf-8") as f:
+            return json.load(f)
+    return {"frame": 0, "offset": 0, "tracked": 0, "failed": 0, "done": False}
+
+
+def save_checkpoint(path: pathlib.Path, ckpt: dict) -> None:
+    # Write then rename so a crash never leaves a half-written checkpoint
+    tmp = path.with_name(path.name + ".tmp")
+    with tmp.open("w", encoding="utf-8") as f:
+        json.dump(ckpt, f)
+    os.replace(tmp, path)
+
+
+def last_time(out_file) -> Optional[float]:
+    """
+    Time of the last sample written to an output file open for reading at its end, or None if it is empty.
+    """
+    end = out_file.tell()
+    out_file.seek(max(end - 4096, 0))
+    lines = out_file.read(end - out_file.tell()).splitlines()
+    return float(lines[-1].split()[0]) if lines else None
+
+
+def process_video(vid_name: pathlib.Path, out_name: pathlib.Path, skip_frames: int, fx: Optional[float], fy: Optional[float],
+                  detector: str, coarse: Optional[float], index: Optional[bool], chunk_size: int) -> dict:
+    ckpt_name = out_name.with_name(out_name.name + ".ckpt")
+    ckpt = load_checkpoint(ckpt_name)
+    result = {"video": vid_name.name, "tracked": 0, "failed": 0, "elapsed": 0.0, "status": "done"}
+    if ckpt["done"]:
+        result.update(tracked=ckpt["tracked"], failed=ckpt["failed"], status="already done")
+        return result
+    resumed = ckpt["frame"] > 0
+
+    start = time.perf_counter()
+    # Seeking by frame number is only exact with the index
+    cap = vidindex.open_video(vid_name, True if resumed else index)
+    if not cap.isOpened():
+        result["status"] = "could not open"
+        return result
+    if resumed:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, ckpt["frame"])
+    # Longest gap expected between consecutive samples, with some slack for variable frame rates
+    max_gap = 1.5 * (1 + skip_frames) / (cap.get(cv2.CAP_PROP_FPS) or 30)
+
+    with open(out_name, "a+b") as out_file:
+        # Anything past the checkpoint was written after the last completed chunk
+        out_file.truncate(ckpt["offset"])
+        out_file.seek(ckpt["offset"])
+        # Check the first new frame against the last sample written and the last frame tracked (which may have
+        # failed), so the resume neither repeats nor skips any
+        known = [t for t in (last_time(out_file), ckpt.get("time")) if t is not None] if resumed else []
+        resume_after = max(known) if known else None
+        lines = []
+        frame = ckpt["frame"]
+        t = ckpt.get("time")
+        tracked = failed = 0
+
+        def flush() -> None:
+            out_file.write("".join(lines).encode("utf-8"))
+            out_file.flush()
+            os.fsync(out_file.fileno())
+            lines.clear()
+            ckpt.update(frame=frame, time=t, offset=out_file.tell(), tracked=ckpt["tracked"] + tracked, failed=ckpt["failed"] + failed)
+            save_checkpoint(ckpt_name, ckpt)
+
+        tracker = cvtrack.Tracker(fx=fx, fy=fy, raise_on_fail=False, detector=detector, coarse=coarse)
+        while True:
+            if not tracker.read(cap):
+                break
+            t = cap.get(cv2.CAP_PROP_POS_MSEC) / 1000
+            if resume_after is not None and t != 0:
+                if t <= resume_after:
+                    continue
+                if "time" in ckpt and t - resume_after > max_gap:
+                    raise ValueError(f"resumed at {t}s but the checkpoint was at {resume_after}s")
+                resume_after = None
+            ((x, y), (pivot_x, pivot_y)), _ = tracker.process()
+            if x is None or pivot_x is None:
+                failed += 1
+            # At the end of the video the time is zero for some reason, same as in gendata.py
+            elif t != 0:
+                lines.append(f"{t} {math.atan2(x - pivot_x, y - pivot_y)}\n")
+                tracked += 1
+            for _ in range(skip_frames):
+                cap.grab()
+            frame += 1 + skip_frames
+            if len(lines) >= chunk_size:
+                flush()
+                result["tracked"] += tracked
+                result["failed"] += failed
+                tracked = failed = 0
+        flush()
+        result["tracked"] += tracked
+        result["failed"] += failed
+    cap.release()
+    ckpt["done"] = True
+    save_checkpoint(ckpt_name, ckpt)
+    result["elapsed"] = time.perf_counter() - start
+    if resumed:
+        result["status"] = "resumed"
+    return result
+
+
+def _run(args) -> dict:
+    try:
+        return process_video(*args)
+    except Exception as e: # pylint: disable=broad-except
+        # Keep the rest of the batch going; the checkpoint lets this video resume later
+        return {"video": args[0].name, "tracked": 0, "failed": 0, "elapsed": 0.0, "status": f"error: {e}"}
+
+
+def main(inputs: List[str], out_dir: pathlib.Path, skip_frames: int, fx: Optional[float], fy: Optional[float], detector: str,
+         coarse: Optional[float], index: Optional[bool], processes: Optional[int], chunk_size: int) -> None:
+    videos = find_videos(inputs)
+    if not videos:
+        print("No videos found")
+        return
+    out_dir.mkdir(parents=True, exist_ok=True)
+    jobs = [(vid, out_dir / (vid.stem + ".txt"), skip_frames, fx, fy, detector, coarse, index, chunk_size) for vid in videos]
+    print(f"Processing {len(jobs)} videos")
+    start = time.perf_counter()
+    results = []
+    with multiprocessing.Pool(processes) as pool:
+        for result in pool.imap_unordered(_run, jobs):
+            print(f"{result['video']}: {result['status']}")
+            results.append(result)
+    elapsed = time.perf_counter() - start
+
+    print()
+    print("Video\tTracked\tFailed\tFrames/s\tStatus")
+    for result in sorted(results, key=lambda r: r["video"]):
+        rate = (result["tracked"] + result["failed"]) / result["elapsed"] if result["elapsed"] else 0
+        print(f"{result['video']}\t{result['tracked']}\t{result['failed']}\t{rate:.1f}\t{result['status']}")
+    total = sum(r["tracked"] + r["failed"] for r in results)
+    print(f"Total: {total} frames in {elapsed:.1f}s ({total / elapsed:.1f} frames/s)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Get time vs angle data from many videos, resuming from checkpoints after interruptions")
+    parser.add_argument("inputs", type=str, nargs="+", help="Video files, directories or glob patterns")
+    parser.add_argument("--out-dir", "-o", type=pathlib.Path, default=pathlib.Path("."), help="Directory for the output files")
+    parser.add_argument("--skip-frames", type=int, default=3)
+    parser.add_argument("--fx", type=float, default=None)
+    parser.add_argument("--fy", type=float, default=None)
+    parser.add_argument("--index", action="store_const", const=True, default=None, help="Seek and take timestamps from a frame index, building it if needed. By default an existing index is used.")
+    parser.add_argument("--detector", choices=cvtrack.DETECTORS.keys(), default="contour")
+    parser.add_argument("--coarse", type=float, default=None, help="Find targets on a frame downscaled by this factor, then refine at full resolution")
+    parser.add_argument("--processes", "-j", type=int, default=None, help="Number of videos processed at once (default: CPU count)")
+    parser.add_argument("--chunk-size", type=int, default=500, help="Samples written between checkpoints")
+    main(**vars(parser.parse_args()))
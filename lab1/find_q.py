@@ -1,56 +1,95 @@
-from fit import load_data
+from fit import load_file
+import argparse
 import sys
 import numpy as np
 from scipy import signal
+from typing import List, Optional, TextIO, Tuple
 
-Q_DIVISOR = 3
+Q_DIVISORS = [2, 3, 4, 5, 6]
+# Minimum time between two maxima for them to be distinct peaks
+MIN_SEPARATION = 0.5
 
-def main():
-    x_data, y_data = load_data(sys.argv)
-    amp = abs(y_data[0])
-    mag = np.exp(-np.pi / Q_DIVISOR) * amp
+def find_extrema(x_data: np.ndarray, y_data: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Find all maxima and minima, returning their times, absolute amplitudes and number of oscillations since the
+    start, sorted in order of oscillations.
+    """
     maxima, _ = signal.find_peaks(y_data, height=0, threshold=0)
     minima, _ = signal.find_peaks(-y_data, height=0, threshold=0)
+    if np.any(np.diff(x_data[maxima]) < MIN_SEPARATION):
+        raise ValueError("Invalid peak detected!")
+    # The first extremum of the same sign as the start is one full oscillation in, the other is half of one
+    osc = np.concatenate([np.arange(len(maxima)) + (1 if y_data[0] > 0 else 0.5),
+                          np.arange(len(minima)) + (1 if y_data[0] < 0 else 0.5)])
+    idx = np.concatenate([maxima, minima])
+    order = np.argsort(osc, kind="stable")
+    return x_data[idx[order]], np.abs(y_data[idx[order]]), osc[order]
 
-    it = iter(maxima)
-    next(it)
-    for i, j in zip(maxima, it):
-        if x_data[j] - x_data[i] < 0.5:
-            print("Error: Invalid peak detected!")
-            sys.exit(1)
-    
-    for i in range(min(len(minima), len(maxima))):
-        # Find first minimum or maximum with value less than or equal to mag
-        max_diff = mag - abs(y_data[maxima[i]])
-        min_diff = mag - abs(y_data[minima[i]])
-        if max_diff >= 0 and min_diff >= 0:
-            # If we're taking the maximum and the data started negative
-            # or if we're taking the minimum and the data started positive
-            # then there's a missing half cycle
-            if max_diff < min_diff:
-                osc = i + 1 if y_data[0] > 0 else i + 0.5
-                t = x_data[maxima[i]]
-                y = y_data[maxima[i]]
-            else:
-                osc = i + 1 if y_data[0] < 0 else i + 0.5
-                t = x_data[minima[i]]
-                y = y_data[minima[i]]
-            break
-        if max_diff >= 0:
-            osc = i + 1 if y_data[0] > 0 else i + 0.5
-            t = x_data[maxima[i]]
-            y = y_data[maxima[i]]
-            break
-        if min_diff >= 0:
-            osc = i + 1 if y_data[0] < 0 else i + 0.5
-            t = x_data[minima[i]]
-            y = y_data[minima[i]]
-            break
+def q_divisors(amp: float, extrema_amp: np.ndarray, osc: np.ndarray, divisors: np.ndarray) -> np.ndarray:
+    """
+    Traditional estimate of Q for every divisor at once: Q/divisor is the number of oscillations until the amplitude
+    falls to exp(-pi/divisor) of the initial amplitude. NaN where the amplitude never gets that low.
+    """
+    mag = np.exp(-np.pi / divisors) * amp
+    below = extrema_amp[np.newaxis, :] <= mag[:, np.newaxis]
+    first = np.argmax(below, axis=1)
+    return np.where(below.any(axis=1), osc[first] * divisors, np.nan)
+
+def q_decrement(extrema_amp: np.ndarray, osc: np.ndarray, y_uncert: float = 0) -> Tuple[float, float]:
+    """
+    Estimate Q and its uncertainty from the logarithmic decrement, with a linear fit of the log amplitude of every
+    extremum against the number of oscillations. ln A drops by pi/Q every oscillation.
+    """
+    if len(osc) < 3:
+        raise ValueError("Not enough extrema to fit the decay")
+    if y_uncert > 0:
+        # The uncertainty of ln A is y_uncert / A
+        (slope, _), cov = np.polyfit(osc, np.log(extrema_amp), 1, w=extrema_amp / y_uncert, cov="unscaled")
     else:
-        print(f"Error: No peak found with amplitude <= {mag}. Try adjusting the Q divisor.")
+        (slope, _), cov = np.polyfit(osc, np.log(extrema_amp), 1, cov=True)
+    q = -np.pi / slope
+    return q, abs(q * np.sqrt(cov[0, 0]) / slope)
+
+def process_file(filename: str, angle_format: str, time_format: str, fps: int, divisors: np.ndarray, y_uncert: float) -> Tuple[float, float, np.ndarray]:
+    x_data, y_data = load_file(filename, angle_format, time_format, fps)
+    _, extrema_amp, osc = find_extrema(x_data, y_data)
+    q, qu = q_decrement(extrema_amp, osc, y_uncert)
+    return q, qu, q_divisors(abs(y_data[0]), extrema_amp, osc, divisors)
+
+def main(data_files: List[str], angle_format: str, time_format: str, fps: int, divisors: List[float],
+         y_uncert: float, summary: Optional[TextIO]) -> None:
+    divisors = np.array(divisors, dtype=np.float64)
+    failed = 0
+    if summary is not None:
+        summary.write("# file Q Q_uncert " + " ".join(f"Q_{d:g}" for d in divisors) + "\n")
+    for filename in data_files:
+        try:
+            q, qu, q_div = process_file(filename, angle_format, time_format, fps, divisors, y_uncert)
+        except (OSError, ValueError) as e:
+            print(f"{filename}: Error: {e}", file=sys.stderr)
+            failed += 1
+            continue
+        print(f"{filename}:")
+        print(f"\tQ (log decrement)\t{q}\t{qu}")
+        for d, qd in zip(divisors, q_div):
+            if np.isnan(qd):
+                print(f"\tQ (divisor {d:g})\tno peak with amplitude <= {np.exp(-np.pi / d):.3f} A0")
+            else:
+                print(f"\tQ (divisor {d:g})\t{qd:g}")
+        if summary is not None:
+            summary.write(f"{filename} {q} {qu} " + " ".join(str(qd) for qd in q_div) + "\n")
+    if summary is not None:
+        summary.close()
+    if failed:
         sys.exit(1)
-    print(f"Found peak: t={t}, angle={y}")
-    print("Q:", osc * Q_DIVISOR)
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Estimate Q factors from time vs angle data.")
+    parser.add_argument("data_files", type=str, nargs="+")
+    parser.add_argument("--angle-format", choices=["rad", "deg"], default="rad")
+    parser.add_argument("--time-format", choices=["sec", "frames"], default="sec")
+    parser.add_argument("--fps", type=int, default=30)
+    parser.add_argument("--divisors", "-d", type=float, nargs="+", default=Q_DIVISORS, help="Q divisors to use for the traditional method")
+    parser.add_argument("--y-uncert", type=float, default=0, help="Angle uncertainty, to weight the log decrement fit")
+    parser.add_argument("--summary", type=argparse.FileType("w", encoding="utf-8"), default=None, help="Write one line of results per file")
+    main(**vars(parser.parse_args()))
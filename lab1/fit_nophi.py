@@ -37,10 +37,10 @@ completely unrealistic (e.g. > 10^6).
 
 import functools
 import sys
-import math
 import scipy.optimize as optimize
 import numpy as np
 import matplotlib.pyplot as plt
+import transform
 from typing import Tuple
 
 DO_FIT = True
@@ -85,31 +85,19 @@ def load_data(args) -> Tuple[np.ndarray, np.ndarray]:
         fps = int(args[4]) if len(args) > 4 else 30
     except ValueError:
         raise ValueError("Invalid format for FPS")
-
-    # Load data
-    x_data = []
-    y_data = []
-    init_time = None
-    for line in open(filename, "r", encoding="utf-8"):
-        line = line.strip()
-        if not line or line.startswith("#"):
-            continue
-        pcs = line.split()
-        if len(pcs) < 2:
-            print("Error: Invalid data format", file=sys.stderr)
-            sys.exit(1)
-        time = float(pcs[0])
-        if time_format == "frames":
-            time /= fps
-        angle = float(pcs[1])
-        if angle_format == "deg":
-            angle = math.radians(angle)
-        if init_time is None:
-            init_time = time
-        time -= init_time
-        x_data.append(time)
-        y_data.append(angle)
-    return np.array(x_data), np.array(y_data)
+    return load_file(filename, angle_format, time_format, fps)
+
+
+def load_file(filename: str, angle_format: str = "rad", time_format: str = "sec", fps: int = 30) -> Tuple[np.ndarray, np.ndarray]:
+    stages = transform.Pipeline()
+    if time_format == "frames":
+        stages.stages.append(transform.Scale("time", 1 / fps))
+    if angle_format == "deg":
+        stages.stages.append(transform.Scale("angle", np.pi / 180))
+    stages.stages.append(transform.Zero("time"))
+    with open(filename, "r", encoding="utf-8") as f:
+        cols = transform.load(f, ["time", "angle"], stages)
+    return cols["time"], cols["angle"]
 
 def main():
     # Parse args
@@ -0,0 +1 @@
+../lab2/uncert.py
\ No newline at end of file
@@ -1,7 +1,8 @@
 import argparse
-import itertools
 from typing import TextIO
 
+import numpy as np
+
 from fit import load_data
 
 
@@ -13,25 +14,17 @@ def main(data_in: TextIO, data_out: TextIO, x_uncert: float, y_uncert: float, x_
     else:
         x_data, y_data = data
         # If we don't want to keep existing uncertainties, then they're basically zero
-        existing_xu = itertools.repeat(0)
-        existing_yu = itertools.repeat(0)
-    xu = []
-    yu = []
-    max_rel_x_unc = 0
-    max_rel_y_unc = 0
-    for x, y, exu, eyu in zip(x_data, y_data, existing_xu, existing_yu):
-        x_unc = max(x_uncert, abs(x_rel_uncert * x), exu)
-        y_unc = max(y_uncert, abs(y_rel_uncert * y), eyu)
-        if x_dep:
-            x_unc = max(x_unc, abs((y_unc / y) * x))
-        if y_dep:
-            y_unc = max(y_unc, abs((x_unc / x) * y))
-        xu.append(x_unc)
-        yu.append(y_unc)
-        max_rel_x_unc = max(max_rel_x_unc, abs(x_unc / x))
-        max_rel_y_unc = max(max_rel_y_unc, abs(y_unc / y))
-    print("Max relative x uncertainty:", max_rel_x_unc)
-    print("Max relative y uncertainty:", max_rel_y_unc)
+        existing_xu = np.zeros_like(x_data)
+        existing_yu = np.zeros_like(y_data)
+    # Each uncertainty is the largest of the candidates, computed for whole columns at once
+    xu = np.maximum(np.maximum(x_uncert, np.abs(x_rel_uncert * x_data)), existing_xu)
+    yu = np.maximum(np.maximum(y_uncert, np.abs(y_rel_uncert * y_data)), existing_yu)
+    if x_dep:
+        xu = np.maximum(xu, np.abs((yu / y_data) * x_data))
+    if y_dep:
+        yu = np.maximum(yu, np.abs((xu / x_data) * y_data))
+    print("Max relative x uncertainty:", np.max(np.abs(xu / x_data), initial=0))
+    print("Max relative y uncertainty:", np.max(np.abs(yu / y_data), initial=0))
     for x, y, x_unc, y_unc in zip(x_data, y_data, xu, yu):
         data_out.write(f"{x} {y} {x_unc} {y_unc}\n")
 
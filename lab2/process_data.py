@@ -1,10 +1,12 @@
 from typing import List, Optional, TextIO, Tuple
-from scipy import signal
+from scipy import fft, signal
 from matplotlib import pyplot as plt
 import tikzplotlib
 import numpy as np
 import argparse
 import itertools
+import multiprocessing
+import sys
 
 
 def load_data(file: TextIO) -> Tuple[np.ndarray, np.ndarray]:
@@ -49,30 +51,188 @@ def averaged_peaks(x_data: np.ndarray, y_data: np.ndarray, merge_threshold: floa
     return np.array(peak_x), np.array(peak_y), np.array(x_uncertainty)
 
 
+def extrema(x_data: np.ndarray, y_data: np.ndarray, merge_threshold: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    max_x, max_y, max_uncert = averaged_peaks(x_data, y_data, merge_threshold)
+    min_x, min_y, min_uncert = averaged_peaks(x_data, -y_data, merge_threshold)
+    # Because it was negated when passed into averaged_peaks
+    min_y = -min_y
+    return max_x, max_y, max_uncert, min_x, min_y, min_uncert
+
+
+def period_rows(max_x: np.ndarray, max_y: np.ndarray, max_uncert: np.ndarray, min_x: np.ndarray, min_y: np.ndarray, min_uncert: np.ndarray) -> np.ndarray:
+    """
+    Amplitude vs period rows (amplitude, period, 0, period uncertainty) from consecutive minima, then maxima.
+    """
+    rows = []
+    for x, y, u in ((min_x, min_y, min_uncert), (max_x, max_y, max_uncert)):
+        n = max(len(x) - 1, 0)
+        rows.append(np.stack([y[:n], np.diff(x), np.zeros(n), np.maximum(u[:-1], u[1:])], axis=1))
+    return np.concatenate(rows)
+
+
+def analytic_signal(x_data: np.ndarray, y_data: np.ndarray, edge_trim: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Instantaneous amplitude and period at every sample from the analytic signal (Hilbert transform). Like the
+    extrema, the amplitude is signed: negative over the half-cycles where the pendulum is on the negative side.
+
+    Uneven traces are first resampled onto a uniform grid. The trace is centred and mirrored at both ends before the
+    transform to reduce edge effects, and edge_trim seconds at each end, where it is still unreliable, are dropped.
+    """
+    if len(x_data) < 2:
+        raise ValueError(f"The analytic signal needs at least 2 samples, but the trace has {len(x_data)}")
+    dt = np.median(np.diff(x_data))
+    t = np.arange(len(x_data)) * dt + x_data[0]
+    y = np.interp(t, x_data, y_data) if not np.allclose(t, x_data) else y_data
+    y = y - np.mean(y)
+    trim = int(round(edge_trim / dt))
+    pad = min(len(y) - 1, max(2 * trim, 1))
+    # Make the padded length fast for the FFT, with the extra on the right
+    total = fft.next_fast_len(len(y) + 2 * pad)
+    padded = np.pad(y, (pad, total - len(y) - pad), mode="reflect")
+    z = signal.hilbert(padded)[pad:pad + len(y)]
+    freq = np.gradient(np.unwrap(np.angle(z)), dt) / (2 * np.pi)
+    keep = slice(trim, len(y) - trim)
+    amp = np.where(np.real(z) < 0, -np.abs(z), np.abs(z))
+    return t[keep], amp[keep], 1 / freq[keep]
+
+
+def analytic_rows(x_data: np.ndarray, y_data: np.ndarray, bins: Optional[int], edge_trim: float) -> np.ndarray:
+    """
+    Amplitude vs period rows (amplitude, period, amplitude uncertainty, period uncertainty) from the instantaneous
+    amplitude and period, averaged in amplitude bins which hold the same number of samples each.
+
+    The positive and negative sides of the swing are binned separately, so the rows have signed amplitudes like
+    those from the extrema. By default each side has one bin per whole cycle in the trace, up to 20. Bins which hold
+    less than one half-cycle are dropped, so the result can be empty for a short trace.
+    """
+    t, amp, period = analytic_signal(x_data, y_data, edge_trim)
+    valid = np.isfinite(period) & (period > 0)
+    t, amp, period = t[valid], amp[valid], period[valid]
+    if len(t) < 2:
+        return np.zeros((0, 4))
+    dt = t[1] - t[0]
+    if bins is None:
+        bins = int(np.clip(len(t) * dt // np.median(period), 1, 20))
+    positive = amp >= 0
+    return np.concatenate([_amplitude_bins(amp[positive], period[positive], dt, bins),
+                           _amplitude_bins(amp[~positive], period[~positive], dt, bins)])
+
+
+def _amplitude_bins(amp: np.ndarray, period: np.ndarray, dt: float, bins: int) -> np.ndarray:
+    if not len(amp):
+        return np.zeros((0, 4))
+    # Equal occupancy rather than equal width, since a decaying swing spends longer at small amplitudes
+    idx = np.clip(np.digitize(amp, np.quantile(amp, np.linspace(0, 1, bins + 1))) - 1, 0, bins - 1)
+    counts = np.bincount(idx, minlength=bins)
+    used = counts > 0
+    n = np.maximum(counts, 1)
+    mean_amp = np.bincount(idx, amp, bins) / n
+    mean_period = np.bincount(idx, period, bins) / n
+    std_amp = np.sqrt(np.maximum(np.bincount(idx, amp * amp, bins) / n - mean_amp ** 2, 0))
+    std_period = np.sqrt(np.maximum(np.bincount(idx, period * period, bins) / n - mean_period ** 2, 0))
+    # Neighbouring samples are strongly correlated, so only count each half-cycle spent in a bin (on this side) as an
+    # independent measurement
+    half_cycles = counts * dt / np.where(used, mean_period / 2, 1)
+    used &= half_cycles >= 1
+    half_cycles = np.maximum(half_cycles, 1)
+    return np.stack([mean_amp, mean_period, std_amp / np.sqrt(half_cycles), std_period / np.sqrt(half_cycles)], axis=1)[used]
+
+
+def process_trial(data_in: str, merge_threshold: float, n: Optional[int], analytic: bool = False, bins: Optional[int] = None, edge_trim: float = 2.0) -> dict:
+    with open(data_in, "r", encoding="utf-8") as f:
+        x_data, y_data = load_data(f)
+    if n is not None:
+        x_data = x_data[:n]
+        y_data = y_data[:n]
+    max_x, max_y, max_uncert, min_x, min_y, min_uncert = extrema(x_data, y_data, merge_threshold)
+    if analytic:
+        try:
+            rows = analytic_rows(x_data, y_data, bins, edge_trim)
+        except ValueError as e:
+            print(f"Warning: {data_in}: {e}", file=sys.stderr)
+            rows = np.zeros((0, 4))
+    else:
+        rows = period_rows(max_x, max_y, max_uncert, min_x, min_y, min_uncert)
+    return {
+        "trial": data_in, "samples": len(x_data), "rows": rows,
+        "extrema_x": np.concatenate([max_x, min_x]), "extrema_y": np.concatenate([max_y, min_y]),
+        "extrema_kind": np.concatenate([np.ones(len(max_x), dtype=np.int8), -np.ones(len(min_x), dtype=np.int8)]),
+    }
+
+
+def _run_trial(args) -> dict:
+    return process_trial(*args)
+
+
+def batch_main(data_in: List[str], data_out: str, merge_threshold: float, export_extrema: Optional[str], n: Optional[int],
+               processes: Optional[int], summary: Optional[TextIO], analytic: bool, bins: Optional[int], edge_trim: float) -> None:
+    with multiprocessing.Pool(processes) as pool:
+        results = pool.map(_run_trial, [(trial, merge_threshold, n, analytic, bins, edge_trim) for trial in data_in])
+
+    empty = [r["trial"] for r in results if not len(r["rows"])]
+    for trial in empty:
+        print(f"Warning: no period data for {trial}", file=sys.stderr)
+
+    # One merged dataset, with the index of the trial as an extra column that loaders ignore
+    with open(data_out, "w", encoding="utf-8") as out_file:
+        for i, result in enumerate(results):
+            out_file.write(f"# trial {i}: {result['trial']}\n")
+        for i, result in enumerate(results):
+            for y, dx, xu, unc in result["rows"]:
+                out_file.write(f"{y} {dx} {xu if analytic else 0} {unc} {i}\n")
+
+    header = "Trial\tSamples\tMaxima\tMinima\tPeriod (mean)\tPeriod (std)\tAmplitude range"
+    print(header)
+    if summary is not None:
+        summary.write("# " + header.replace("\t", " | ") + "\n")
+    for result in results:
+        rows = result["rows"]
+        kind = result["extrema_kind"]
+        if len(rows):
+            stats = f"{np.mean(rows[:, 1]):.6g}\t{np.std(rows[:, 1]):.3g}\t{np.min(np.abs(rows[:, 0])):.4g} to {np.max(np.abs(rows[:, 0])):.4g}"
+        else:
+            stats = "-\t-\t-"
+        line = f"{result['trial']}\t{result['samples']}\t{np.count_nonzero(kind > 0)}\t{np.count_nonzero(kind < 0)}\t{stats}"
+        print(line)
+        if summary is not None:
+            summary.write(line.replace("\t", " | ") + "\n")
+    if summary is not None:
+        summary.close()
+
+    if export_extrema is not None:
+        np.savez(export_extrema, trials=np.array([r["trial"] for r in results]),
+                 trial=np.concatenate([np.full(len(r["extrema_x"]), i) for i, r in enumerate(results)]),
+                 x=np.concatenate([r["extrema_x"] for r in results]), y=np.concatenate([r["extrema_y"] for r in results]),
+                 kind=np.concatenate([r["extrema_kind"] for r in results]))
+    if empty:
+        sys.exit(1)
+
+
 def main(data_in: TextIO, data_out: TextIO, merge_threshold: float, graph: bool, save_graph: Optional[TextIO],
-         xlim: List[float], ylim: List[float], no_write: bool, export_extrema: TextIO, n: int) -> None:
+         xlim: List[float], ylim: List[float], no_write: bool, export_extrema: TextIO, n: int, analytic: bool, bins: Optional[int], edge_trim: float) -> None:
     x_data, y_data = load_data(data_in)
     if n is not None:
         x_data = x_data[:n]
         y_data = y_data[:n]
-    max_x, max_y, max_uncert = averaged_peaks(x_data, y_data, merge_threshold)
-    min_x, min_y, min_uncert = averaged_peaks(x_data, -y_data, merge_threshold)
-    min_y = -min_y
+    max_x, max_y, max_uncert, min_x, min_y, min_uncert = extrema(x_data, y_data, merge_threshold)
     if export_extrema is not None:
         for x, y in zip(itertools.chain(max_x, min_x), itertools.chain(max_y, min_y)):
             export_extrema.write(f"{x} {y}\n")
-    # Because it was negated when passed into averaged_peaks
-    if not no_write:
+    if not no_write and analytic:
+        try:
+            rows = analytic_rows(x_data, y_data, bins, edge_trim)
+        except ValueError as e:
+            print(f"Error: {e}", file=sys.stderr)
+            sys.exit(1)
+        if not len(rows):
+            print("Warning: no amplitude bin holds a whole cycle; try fewer --bins or a shorter --edge-trim", file=sys.stderr)
+            sys.exit(1)
         with open(data_out, "w", encoding="utf-8") as out_file:
-            for i in range(len(min_x) - 1):
-                y = min_y[i]
-                dx = min_x[i + 1] - min_x[i]
-                unc = max(min_uncert[i], min_uncert[i + 1])
-                out_file.write(f"{y} {dx} {0} {unc}\n")
-            for i in range(len(max_x) - 1):
-                y = max_y[i]
-                dx = max_x[i + 1] - max_x[i]
-                unc = max(max_uncert[i], max_uncert[i + 1])
+            for y, dx, xu, unc in rows:
+                out_file.write(f"{y} {dx} {xu} {unc}\n")
+    elif not no_write:
+        with open(data_out, "w", encoding="utf-8") as out_file:
+            for y, dx, _, unc in period_rows(max_x, max_y, max_uncert, min_x, min_y, min_uncert):
                 out_file.write(f"{y} {dx} {0} {unc}\n")
     if graph:
         plt.scatter(x_data, y_data, label="Data", s=4)
@@ -92,7 +252,7 @@ def main(data_in: TextIO, data_out: TextIO, merge_threshold: float, graph: bool,
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Process raw data from gendata.py into data for lab 2.")
-    parser.add_argument("data_in", type=argparse.FileType("r", encoding="utf-8"))
+    parser.add_argument("data_in", type=str, nargs="+", help="Raw data file, or with --batch, any number of trial files")
     parser.add_argument("data_out", type=str)
     parser.add_argument("--merge-threshold", type=float, default=0.5)
     parser.add_argument("--graph", action="store_true")
@@ -100,6 +260,25 @@ if __name__ == "__main__":
     parser.add_argument("--xlim", type=float, nargs=2, default=None)
     parser.add_argument("--ylim", type=float, nargs=2, default=None)
     parser.add_argument("--no-write", action="store_true")
-    parser.add_argument("--export-extrema", type=argparse.FileType("w", encoding="utf-8"), default=None)
+    parser.add_argument("--export-extrema", type=str, default=None, help="Text file of extrema, or with --batch, one .npz file of the extrema of every trial")
     parser.add_argument("-n", type=int, default=None)
-    main(**vars(parser.parse_args()))
+    parser.add_argument("--analytic", action="store_true", help="Get the period vs amplitude data from the instantaneous amplitude and period of the analytic signal (Hilbert transform), averaged in amplitude bins, instead of from each pair of extrema")
+    parser.add_argument("--bins", type=int, default=None, help="Number of amplitude bins on each side of the swing for --analytic (default: one per whole cycle, up to 20)")
+    parser.add_argument("--edge-trim", type=float, default=2.0, help="Seconds to drop from each end of the trace for --analytic, where the transform is unreliable")
+    parser.add_argument("--batch", action="store_true", help="Process every trial in parallel into one merged file, with the trial index as a fifth column")
+    parser.add_argument("--processes", "-j", type=int, default=None, help="Number of worker processes for --batch (default: one per CPU)")
+    parser.add_argument("--summary", type=argparse.FileType("w", encoding="utf-8"), default=None, help="Write the per-trial summary of --batch to a file")
+    args = vars(parser.parse_args())
+    batch, processes, summary = args.pop("batch"), args.pop("processes"), args.pop("summary")
+    if batch:
+        if args["graph"] or args["save_graph"] is not None or args["no_write"]:
+            parser.error("--graph, --save-graph and --no-write cannot be used with --batch")
+        batch_main(args["data_in"], args["data_out"], args["merge_threshold"], args["export_extrema"], args["n"], processes, summary,
+                   args["analytic"], args["bins"], args["edge_trim"])
+    else:
+        if len(args["data_in"]) != 1:
+            parser.error("Use --batch to process more than one file")
+        args["data_in"] = open(args["data_in"][0], "r", encoding="utf-8")
+        if args["export_extrema"] is not None:
+            args["export_extrema"] = open(args["export_extrema"], "w", encoding="utf-8")
+        main(**args)
@@ -0,0 +1,279 @@
+"""
+Composable stages that transform whole columns of whitespace-separated data files.
+
+Rows are read in chunks into named NumPy columns, passed through a list of stages in order and written back out, so
+large files are processed as a few vectorized operations. Stages may keep state between chunks (e.g. the first time
+seen, or the next auto-incremented x value), so the result does not depend on the chunk size.
+
+Constants such as offsets, scale factors and model parameters can be numbers or names looked up in a fit result file
+(a JSON object like the one written by lab3/fit_length.py --save-params).
+"""
+import abc
+import argparse
+import itertools
+import json
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, TextIO, Tuple
+
+import numpy as np
+
+import uncert
+
+Columns = Dict[str, np.ndarray]
+
+
+class Stage(abc.ABC):
+    """
+    A transformation of some of the columns of a chunk of rows.
+    """
+
+    @abc.abstractmethod
+    def __call__(self, cols: Columns) -> Columns:
+        pass
+
+
+class Offset(Stage):
+    """
+    Subtract a constant from a column.
+    """
+
+    def __init__(self, column: str, value: float = 0) -> None:
+        self.column = column
+        self.value = value
+
+    def __call__(self, cols: Columns) -> Columns:
+        cols[self.column] = cols[self.column] - self.value
+        return cols
+
+
+class Negate(Stage):
+    """
+    Negate a column, if enabled.
+    """
+
+    def __init__(self, column: str, enabled: bool = True) -> None:
+        self.column = column
+        self.enabled = enabled
+
+    def __call__(self, cols: Columns) -> Columns:
+        if self.enabled:
+            cols[self.column] = -cols[self.column]
+        return cols
+
+
+class Scale(Stage):
+    """
+    Multiply a column by a constant, e.g. to convert units.
+    """
+
+    def __init__(self, column: str, factor: float) -> None:
+        self.column = column
+        self.factor = factor
+
+    def __call__(self, cols: Columns) -> Columns:
+        cols[self.column] = cols[self.column] * self.factor
+        return cols
+
+
+class Zero(Stage):
+    """
+    Subtract the first value of a column from every value, so e.g. time starts at zero.
+    """
+
+    def __init__(self, column: str) -> None:
+        self.column = column
+        self.first = None # type: Optional[float]
+
+    def __call__(self, cols: Columns) -> Columns:
+        col = cols[self.column]
+        if self.first is None and len(col):
+            self.first = col[0]
+        if self.first is not None:
+            cols[self.column] = col - self.first
+        return cols
+
+
+class Step(Stage):
+    """
+    Fill in missing (NaN) values of a column with an auto-incremented value, which starts at current and goes up by
+    step for every value filled in.
+    """
+
+    def __init__(self, column: str, current: float = 0, step: float = 0) -> None:
+        self.column = column
+        self.current = current
+        self.step = step
+
+    def __call__(self, cols: Columns) -> Columns:
+        col = cols[self.column].copy()
+        missing = np.isnan(col)
+        count = np.count_nonzero(missing)
+        col[missing] = self.current + self.step * np.arange(count)
+        self.current += self.step * count
+        cols[self.column] = col
+        return cols
+
+
+class Apply(Stage):
+    """
+    Set a column to a function of other columns and constants, func(*columns, *params).
+    """
+
+    def __init__(self, column: str, func: Callable, inputs: Sequence[str], params: Sequence[float] = ()) -> None:
+        self.column = column
+        self.func = func
+        self.inputs = inputs
+        self.params = params
+
+    def __call__(self, cols: Columns) -> Columns:
+        cols[self.column] = self.func(*(cols[c] for c in self.inputs), *self.params)
+        return cols
+
+
+class Propagate(Stage):
+    """
+    Set a column and its uncertainty to a function of columns with uncertainties and of fit parameters with a
+    covariance, called as func(*inputs, *params, **consts) where consts are columns taken as exact.
+
+    The uncertainties are propagated with uncert.propagate; jac, if given, takes the same arguments as func.
+    """
+
+    def __init__(self, column: str, uncert_column: str, func: Callable, inputs: Sequence[str], uncerts: Sequence[str],
+                 params: Sequence[float] = (), param_cov: Optional[np.ndarray] = None, consts: Sequence[str] = (),
+                 jac: Optional[Callable] = None) -> None:
+        self.column = column
+        self.uncert_column = uncert_column
+        self.func = func
+        self.inputs = inputs
+        self.uncerts = uncerts
+        self.params = params
+        self.param_cov = np.zeros((len(params), len(params))) if param_cov is None else np.asarray(param_cov)
+        self.consts = consts
+        self.jac = jac
+
+    def __call__(self, cols: Columns) -> Columns:
+        consts = {c: cols[c] for c in self.consts}
+        cov = uncert.block_cov(uncert.diag_cov(*(cols[c] for c in self.uncerts)), self.param_cov)
+        jac = (lambda *args: self.jac(*args, **consts)) if self.jac is not None else None
+        y, y_cov = uncert.propagate(lambda *args: self.func(*args, **consts), [cols[c] for c in self.inputs] + list(self.params), cov, jac=jac)
+        cols[self.column] = y[:, 0]
+        cols[self.uncert_column] = uncert.stdev(y_cov)[:, 0]
+        return cols
+
+
+class Pipeline:
+    """
+    A sequence of stages applied in order.
+    """
+
+    def __init__(self, stages: Iterable[Stage] = ()) -> None:
+        self.stages = list(stages)
+
+    def __call__(self, cols: Columns) -> Columns:
+        for stage in self.stages:
+            cols = stage(cols)
+        return cols
+
+    def run(self, data_in: TextIO, data_out: TextIO, names: Sequence[str], chunk_size: int = 100000) -> int:
+        """
+        Transform a whole file chunk by chunk. Returns the number of rows written.
+        """
+        rows = 0
+        for cols in read_chunks(data_in, names, chunk_size):
+            write_columns(data_out, self(cols), names)
+            rows += len(cols[names[0]])
+        return rows
+
+
+def read_chunks(file: TextIO, names: Sequence[str], chunk_size: int = 100000) -> Iterator[Columns]:
+    """
+    Read a data file in chunks of at most chunk_size rows, skipping blank lines and comments.
+
+    Columns after the first two that are missing from the file (such as uncertainties) are filled with zeros, and
+    extra columns are ignored.
+    """
+    lines = (line for line in file if line.strip() and not line.lstrip().startswith("#"))
+    while True:
+        chunk = list(itertools.islice(lines, chunk_size))
+        if not chunk:
+            return
+        data = np.loadtxt(chunk, ndmin=2)
+        if data.shape[1] < min(2, len(names)):
+            raise ValueError("Invalid data format")
+        yield {name: data[:, i] if i < data.shape[1] else np.zeros(len(data)) for i, name in enumerate(names)}
+
+
+def load(file: TextIO, names: Sequence[str], pipeline: Optional[Pipeline] = None, chunk_size: int = 100000) -> Columns:
+    """
+    Read and optionally transform a whole data file into columns.
+    """
+    chunks = [pipeline(cols) if pipeline is not None else cols for cols in read_chunks(file, names, chunk_size)]
+    if not chunks:
+        return {name: np.zeros(0) for name in names}
+    return {name: np.concatenate([c[name] for c in chunks]) for name in names}
+
+
+def write_columns(file: TextIO, cols: Columns, names: Sequence[str]) -> None:
+    """
+    Write columns as space-separated rows.
+    """
+    np.savetxt(file, np.column_stack([cols[name] for name in names]), fmt="%s")
+
+
+def load_params(file: TextIO) -> Tuple[Dict[str, float], Optional[np.ndarray]]:
+    """
+    Load named fit parameters and their covariance (if present, in the order the parameters appear).
+    """
+    fit = json.load(file)
+    cov = fit.pop("cov", None)
+    return fit, np.array(cov) if cov is not None else None
+
+
+def _value(token: str, params: Dict[str, float]) -> float:
+    return params[token] if token in params else float(token)
+
+
+STAGES = {
+    "offset": (Offset, 2),
+    "negate": (Negate, 1),
+    "scale": (Scale, 2),
+    "zero": (Zero, 1),
+    "step": (Step, 3),
+}
+
+
+def parse_stage(spec: List[str], params: Dict[str, float]) -> Stage:
+    """
+    Build a stage from its name, column and constants, e.g. ["offset", "x", "l0"] or ["scale", "y", "0.0174533"].
+    """
+    name, *args = spec
+    if name not in STAGES:
+        raise ValueError(f"Unknown stage {name}, expected one of {', '.join(STAGES)}")
+    cls, nargs = STAGES[name]
+    if len(args) != nargs:
+        raise ValueError(f"Stage {name} takes {nargs} arguments")
+    column, *consts = args
+    return cls(column, *(_value(c, params) for c in consts))
+
+
+def main(data_in: TextIO, data_out: TextIO, columns: str, stage: Optional[List[List[str]]], params: Optional[TextIO], chunk_size: int) -> None:
+    names = columns.split()
+    param_values = load_params(params)[0] if params is not None else {}
+    pipeline = Pipeline(parse_stage(spec, param_values) for spec in stage or [])
+    rows = pipeline.run(data_in, data_out, names, chunk_size)
+    data_out.close()
+    print(f"Transformed {rows} rows")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Apply column transform stages to a data file.")
+    parser.add_argument("data_in", type=argparse.FileType("r", encoding="utf-8"))
+    parser.add_argument("data_out", type=argparse.FileType("w", encoding="utf-8"))
+    parser.add_argument("--columns", type=str, default="x y xu yu", help="Names of the columns in the file")
+    parser.add_argument("--stage", "-s", nargs="+", action="append", help="Stage to apply, in order: offset COL VALUE, negate COL, scale COL FACTOR, zero COL or step COL START STEP. Constants can be names from --params.")
+    parser.add_argument("--params", type=argparse.FileType("r", encoding="utf-8"), default=None, help="JSON file of named constants, such as from lab3/fit_length.py --save-params")
+    parser.add_argument("--chunk-size", type=int, default=100000)
+    args = parser.parse_args()
+    try:
+        main(**vars(args))
+    except ValueError as e:
+        parser.error(str(e))
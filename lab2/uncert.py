@@ -0,0 +1,96 @@
+"""
+Vectorized propagation of uncertainties with full covariances.
+
+Inputs are given as a sequence of columns (arrays of the same length, or scalars which are shared by every row),
+and the covariance of the inputs either as one matrix shared by every row or as one matrix per row. A function of the
+columns is propagated to first order as J C J^T, with the Jacobian J either given analytically or computed numerically
+by central differences over whole columns at once.
+"""
+from typing import Callable, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+def _columns(columns: Sequence, n: Optional[int] = None) -> np.ndarray:
+    """
+    Stack columns into an (n, k) array, broadcasting scalars.
+    """
+    columns = [np.asarray(c, dtype=np.float64) for c in columns]
+    if n is None:
+        n = max((c.size for c in columns if c.ndim > 0), default=1)
+    return np.stack([np.broadcast_to(c, (n,)) for c in columns], axis=1)
+
+
+def _outputs(y, n: int) -> np.ndarray:
+    """
+    Turn the result of a function (one array or a tuple of arrays) into an (n, m) array.
+    """
+    if isinstance(y, tuple):
+        return _columns(y, n)
+    return np.broadcast_to(np.asarray(y, dtype=np.float64), (n,)).reshape(n, 1)
+
+
+def jacobian(func: Callable, x: np.ndarray) -> np.ndarray:
+    """
+    Numerical Jacobian of func at every row of x (shape (n, k)), with shape (n, m, k).
+    """
+    n, k = x.shape
+    # Step size that balances truncation and rounding error for central differences
+    h = np.cbrt(np.finfo(np.float64).eps) * np.maximum(np.abs(x), 1)
+    cols = []
+    for j in range(k):
+        up = x.copy()
+        down = x.copy()
+        up[:, j] += h[:, j]
+        down[:, j] -= h[:, j]
+        diff = _outputs(func(*up.T), n) - _outputs(func(*down.T), n)
+        cols.append(diff / (2 * h[:, j:j + 1]))
+    return np.stack(cols, axis=2)
+
+
+def propagate(func: Callable, columns: Sequence, cov: np.ndarray, jac: Optional[Callable] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Propagate the covariance of the input columns through func(*columns).
+
+    cov has shape (k, k) to share it between rows, or (n, k, k). jac, if given, should take the same arguments as func
+    and return the Jacobian with shape (n, m, k); otherwise it is computed numerically.
+
+    Returns the values with shape (n, m) and their covariance with shape (n, m, m).
+    """
+    cov = np.asarray(cov, dtype=np.float64)
+    n = cov.shape[0] if cov.ndim == 3 else None
+    x = _columns(columns, n)
+    n = x.shape[0]
+    y = _outputs(func(*x.T), n)
+    j = np.asarray(jac(*x.T), dtype=np.float64) if jac is not None else jacobian(func, x)
+    j = np.broadcast_to(j, (n, y.shape[1], x.shape[1]))
+    cov = np.broadcast_to(cov, (n, x.shape[1], x.shape[1]))
+    return y, np.einsum("nmk,nkl,npl->nmp", j, cov, j)
+
+
+def diag_cov(*stdevs) -> np.ndarray:
+    """
+    Per-row covariance matrices of independent columns with the given standard deviations.
+    """
+    s = _columns(stdevs)
+    return np.einsum("nk,kl->nkl", s ** 2, np.eye(s.shape[1]))
+
+
+def block_cov(row_cov: np.ndarray, shared_cov: np.ndarray) -> np.ndarray:
+    """
+    Combine per-row covariances (n, a, a) with a covariance shared by every row (b, b), such as that of fit
+    parameters, into (n, a + b, a + b). The two groups are assumed to be independent.
+    """
+    n, a, _ = row_cov.shape
+    b = shared_cov.shape[0]
+    cov = np.zeros((n, a + b, a + b))
+    cov[:, :a, :a] = row_cov
+    cov[:, a:, a:] = shared_cov
+    return cov
+
+
+def stdev(cov: np.ndarray) -> np.ndarray:
+    """
+    Standard deviations from covariance matrices, with shape (n, m).
+    """
+    return np.sqrt(np.diagonal(cov, axis1=-2, axis2=-1))
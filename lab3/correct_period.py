@@ -1,24 +1,54 @@
 import click
-from typing import TextIO
+import numpy as np
+import transform
+from typing import Optional, TextIO
 from fit_length import fitfunc
 
 spring_k = 194
 g = 9.806
 length = 1.0745
 
+# Used when no parameter file from fit_length.py --save-params is given
 k = 2.018099069322445
 n = 0.4965279402153859
 l0 = -0.01272678366160228
 
+
+def corrected_period(y: np.ndarray, k: float, n: float, l0: float, x: np.ndarray) -> np.ndarray:
+    # Remove the change in period caused by the spring stretching under the mass x (in g)
+    correction = fitfunc(length + (x / 1000 * g) / spring_k, k, n, l0) - fitfunc(length, k, n, l0)
+    return y - correction
+
+
+def corrected_period_jac(y: np.ndarray, k: np.ndarray, n: np.ndarray, l0: np.ndarray, x: np.ndarray) -> np.ndarray:
+    # Derivatives of corrected_period with respect to (y, k, n, l0), with shape (rows, 1, 4)
+    # The parameters are passed as columns, but are the same for every row
+    k, n, l0 = k[0], n[0], l0[0]
+    def grad(l):
+        base = (l0 + l) ** n
+        return np.stack([base, k * base * np.log(l0 + l), k * n * base / (l0 + l)], axis=-1)
+    stretched = length + (x / 1000 * g) / spring_k
+    dparams = -(grad(stretched) - grad(np.full_like(stretched, length)))
+    return np.concatenate([np.ones((len(y), 1)), dparams], axis=1)[:, np.newaxis, :]
+
+
 @click.command()
 @click.argument("data_in", type=click.File("r", encoding="utf-8"))
 @click.argument("data_out", type=click.File("w", encoding="utf-8"))
-def main(data_in: TextIO, data_out: TextIO) -> None:
-    for line in data_in:
-        x, y, xu, yu = (float(i) for i in line.split())
-        correction = fitfunc(length + (x / 1000 * g) / spring_k, k, n, l0) - fitfunc(length, k, n, l0)
-        y -= correction
-        data_out.write(f"{x} {y} {xu} {yu}\n")
+@click.option("--params", "-p", type=click.File("r", encoding="utf-8"), default=None, help="Fit parameters and covariance from fit_length.py --save-params")
+@click.option("--chunk-size", type=click.IntRange(min=1), default=100000, help="Number of rows to process at once")
+def main(data_in: TextIO, data_out: TextIO, params: Optional[TextIO], chunk_size: int) -> None:
+    if params is not None:
+        fit, fit_cov = transform.load_params(params)
+        fit_params = (fit["k"], fit["n"], fit["l0"])
+    else:
+        fit_params = (k, n, l0)
+        fit_cov = None
+    # The x uncertainty stays with x, so only the period and the (shared, correlated) fit parameters are propagated
+    pipeline = transform.Pipeline([
+        transform.Propagate("y", "yu", corrected_period, ["y"], ["yu"], fit_params, fit_cov, consts=["x"], jac=corrected_period_jac),
+    ])
+    pipeline.run(data_in, data_out, ["x", "y", "xu", "yu"], chunk_size)
 
 
 if __name__ == "__main__":
@@ -0,0 +1 @@
+../lab1/fit.py
\ No newline at end of file
@@ -1,4 +1,8 @@
+import resident
+# Run on the resident worker instead if one is running (see worker.py)
+resident.forward(__name__, plots=True)
 import functools
+import json
 import click
 import numpy as np
 from typing import List, TextIO, Tuple, Union
@@ -39,15 +43,16 @@ def odr_fitfunc(p: List[float], l: float) -> float:
     return p[0] * (p[2] + l) ** p[1]
 
 
-def do_fit(x_data: np.ndarray, y_data: np.ndarray, x_uncert: np.ndarray, y_uncert: np.ndarray, guesses, use_odr: bool) -> Tuple[Tuple[float, float, float], Tuple[float, float, float]]:
+def do_fit(x_data: np.ndarray, y_data: np.ndarray, x_uncert: np.ndarray, y_uncert: np.ndarray, guesses, use_odr: bool) -> Tuple[Tuple[float, float, float], Tuple[float, float, float], np.ndarray]:
     if use_odr:
         model = odr.Model(odr_fitfunc)
         data = odr.RealData(x_data, y_data, sx=x_uncert, sy=y_uncert)
         output = odr.ODR(data, model, beta0=guesses).run()
-        return (output.beta, output.sd_beta)
+        # cov_beta is unscaled; sd_beta is the square root of its diagonal times the residual variance
+        return (output.beta, output.sd_beta, output.cov_beta * output.res_var)
     else:
         popt, pcov = optimize.curve_fit(fitfunc, x_data, y_data, p0=guesses)
-        return (popt, (np.sqrt(pcov[i, i]) for i in range(len(guesses))))
+        return (popt, (np.sqrt(pcov[i, i]) for i in range(len(guesses))), pcov)
 
 
 @click.command()
@@ -58,17 +63,20 @@ def do_fit(x_data: np.ndarray, y_data: np.ndarray, x_uncert: np.ndarray, y_uncer
 @click.option("--sep", "-s", type=str, default=None, help="Separator in the data file")
 @click.option("--odr/--no-odr", "use_odr", default=False, help="Use ODR instead of least squares and take into account uncertainties")
 @click.option("--save-residuals", type=click.File("w", encoding="utf-8"), default=None, help="Save residuals to a file")
-def main(data_in: TextIO, guess_k: float, guess_n: float, guess_l: float, sep: str, use_odr: bool, save_residuals: TextIO):
+@click.option("--save-params", type=click.File("w", encoding="utf-8"), default=None, help="Save the fit parameters and their covariance to a JSON file")
+def main(data_in: TextIO, guess_k: float, guess_n: float, guess_l: float, sep: str, use_odr: bool, save_residuals: TextIO, save_params: TextIO):
     """
     Fit period to a function of length for lab 3a.
     """
     x_data, y_data, x_uncert, y_uncert = load_data(data_in, uncert=True, sep=sep)
 
-    (k, n, l0), (sk, sn, sl0) = do_fit(x_data, y_data, x_uncert, y_uncert, (guess_k, guess_n, guess_l), use_odr)
+    (k, n, l0), (sk, sn, sl0), cov = do_fit(x_data, y_data, x_uncert, y_uncert, (guess_k, guess_n, guess_l), use_odr)
     print("Qty\tValue\t\t\tStdev/Uncertainty")
     print(f"k\t{k}\t{sk}")
     print(f"n\t{n}\t{sn}")
     print(f"L0\t{l0}\t{sl0}")
+    if save_params is not None:
+        json.dump({"k": k, "n": n, "l0": l0, "cov": np.asarray(cov).tolist()}, save_params, indent=4)
     
     bestfit = functools.partial(fitfunc, k=k, n=n, l0=l0)
     fig, (ax1, ax2, ax3) = plt.subplots(3, 1)
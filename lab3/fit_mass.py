@@ -1,3 +1,6 @@
+import resident
+# Run on the resident worker instead if one is running (see worker.py)
+resident.forward(__name__, plots=True)
 import functools
 import click
 import numpy as np
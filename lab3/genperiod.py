@@ -1,15 +1,24 @@
+import sys
+import resident
+# Run on the resident worker instead if one is running (see worker.py)
+resident.forward(__name__, plots="--plot" in sys.argv[1:])
 import ast
 import click
+import multiprocessing
 import cv2
 import cvtrack
-import math
 import numpy as np
 import itertools
 import pathlib
-import sys
+import framecache
+import spectral
+import transform
+from fit import INIT_GUESS, fit_func
 from process_data import averaged_peaks
-from typing import List, TextIO, Tuple
+from traces import save_trace_file
+from typing import List, Optional, TextIO, Tuple
 from matplotlib import pyplot as plt
+from scipy import optimize
 
 
 def parse_time(t: str, framerate: int = 30) -> float:
@@ -22,6 +31,54 @@ def parse_time(t: str, framerate: int = 30) -> float:
     return float(t)
 
 
+def fit_clip(time: np.ndarray, angle: np.ndarray, period: float, tau: float) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Fit the damped cosine fit.fit_func to a whole clip, starting from the given period and decay time.
+
+    Returns the parameters (a, tau, period, phi) and their standard deviations.
+    """
+    t = time - time[0]
+    # Amplitude and phase of the best sinusoid at the starting period
+    w = 2 * np.pi / period
+    (c, s), *_ = np.linalg.lstsq(np.stack([np.cos(w * t), np.sin(w * t)], axis=1), angle - np.mean(angle), rcond=None)
+    popt, pcov = optimize.curve_fit(fit_func, t, angle, p0=(np.hypot(c, s), tau, period, np.arctan2(-s, c)))
+    return popt, np.sqrt(np.diag(pcov))
+
+
+def _fit_series(series: List[Tuple[np.ndarray, np.ndarray, Optional[float], float]]) -> List[Tuple[float, float]]:
+    """
+    Fit the clips of one !xstep series in order. Each fit starts from the decay time of the previous clip, and from
+    both the clip's own peak-based period and the previous fitted period, keeping whichever fits better.
+    Returns the period and its standard deviation for each clip, or NaN if the fit failed.
+    """
+    tau = INIT_GUESS[1]
+    prev_period = None
+    results = []
+    for time, angle, peak_period, spectral_period in series:
+        seeds = {p for p in (peak_period, prev_period) if p is not None} or {spectral_period}
+        best = None
+        for seed in seeds:
+            try:
+                popt, stdevs = fit_clip(time, angle, seed, tau)
+            except (RuntimeError, ValueError):
+                continue
+            # A degenerate fit (e.g. no visible decay in a short clip) has no usable uncertainty
+            if not np.isfinite(stdevs[2]):
+                continue
+            residual = np.sum((angle - fit_func(time - time[0], *popt)) ** 2)
+            if best is None or residual < best[0]:
+                best = (residual, popt, stdevs)
+        if best is None:
+            results.append((np.nan, np.nan))
+            continue
+        _, popt, stdevs = best
+        if popt[1] > 0 and np.isfinite(stdevs[1]):
+            tau = popt[1]
+        prev_period = popt[2]
+        results.append((popt[2], stdevs[2]))
+    return results
+
+
 @click.command()
 @click.argument("times_in", type=click.Path(exists=True, readable=True, path_type=pathlib.Path))
 @click.argument("data_out", type=click.File("w"))
@@ -35,11 +92,23 @@ def parse_time(t: str, framerate: int = 30) -> float:
 @click.option("--period-uncert", "--pu", type=float, default=0, help="Absolute period uncertainty before averaging")
 @click.option("--offset", "-o", type=float, default=0, help="Subtract an offset from all x values")
 @click.option("--negate/--no-negate", "-n/-N", default=False, help="Negate x values")
+@click.option("--period-method", type=click.Choice(["peaks", "spectral", "fit"]), default="peaks", help="Find the period from the differences between averaged peaks, from the highest peak of a Lomb-Scargle periodogram (better for short or unevenly sampled clips), or by fitting a damped cosine to every sample of each clip")
+@click.option("--processes", "-j", type=click.IntRange(min=1), default=None, help="Number of processes for --period-method fit (default: one per CPU)")
+@click.option("--min-period", type=click.FloatRange(min=0, min_open=True), default=None, help="Shortest period to search for with --period-method spectral")
+@click.option("--max-period", type=click.FloatRange(min=0, min_open=True), default=None, help="Longest period to search for with --period-method spectral")
 @click.option("--plot/--no-plot", default=False, help="Plot extracted angle data")
+@click.option("--detector", type=click.Choice(list(cvtrack.DETECTORS)), default="contour", help="Blob detector backend")
+@click.option("--coarse", type=click.FloatRange(min=0, min_open=True, max=1), default=None, help="Find targets on a frame downscaled by this factor, then refine at full resolution")
+@click.option("--index/--no-index", default=None, help="Seek and take timestamps from frame indices, building them if needed. By default existing indices are used.")
+@click.option("--cache/--no-cache", default=False, help="Read frames from the memory-mapped frame cache, decoding videos into it on first use")
+@click.option("--cache-scale", type=click.FloatRange(min=0, min_open=True, max=1), default=None, help="Downscale factor of the cached frames")
+@click.option("--cache-hsv/--no-cache-hsv", default=False, help="Cache frames already converted to HSV")
+@click.option("--correction", type=click.Path(exists=True, readable=True), default=None, help="Lens and perspective correction file from tools/calibrate_camera.py")
+@click.option("--save-traces", type=click.Path(dir_okay=False, writable=True, path_type=pathlib.Path), default=None, help="Save the tracked angle of every clip to an .npz file, e.g. for sweep_peaks.py")
 @click.option("--peak-option", "-p", multiple=True, type=(str, str), help="Additional kwargs to pass to scipy.signal.find_peaks()")
 def main(times_in: pathlib.Path, data_out: TextIO, fx: float, fy: float, merge_threshold: float, x_uncert: float,
          x_rel_uncert: float, y_uncert: float, y_rel_uncert: float, period_uncert: float, offset: float, negate: bool,
-         plot: bool, peak_option: List[Tuple[str, str]]) -> None:
+         period_method: str, processes: Optional[int], min_period: float, max_period: float, plot: bool, detector: str, coarse: float, index: bool, cache: bool, cache_scale: float, cache_hsv: bool, correction: str, save_traces: pathlib.Path, peak_option: List[Tuple[str, str]]) -> None:
     """
     Generate period data.
 
@@ -47,9 +116,18 @@ def main(times_in: pathlib.Path, data_out: TextIO, fx: float, fy: float, merge_t
     """
     
     cap = None # type: cv2.VideoCapture
-    current_x = 0
-    x_step = 0
+    # x values of "~" are filled in by the step stage, then offset and negated
+    x_auto = transform.Step("x")
+    x_offset = transform.Offset("x", offset)
+    x_negate = transform.Negate("x", negate)
+    x_stages = transform.Pipeline([x_auto, x_offset, x_negate])
     peak_options = {arg: ast.literal_eval(val) for arg, val in peak_option}
+    correction = cvtrack.Correction.load(correction) if correction is not None else None
+    tracker = cvtrack.Tracker(fx=fx, fy=fy, detector=detector, coarse=coarse, hsv_input=False)
+    traces = []
+    # Clips to fit with --period-method fit, grouped into !xstep series, as (x, xu, fit input, fallback period and uncertainty)
+    series = []
+    new_series = True
     with times_in.open() as f:
         for line in f:
             line = line.strip()
@@ -64,32 +142,29 @@ def main(times_in: pathlib.Path, data_out: TextIO, fx: float, fy: float, merge_t
                     else:
                         vidpath = str(times_in.with_name(pcs[1]))
                     print(f"Using video file {vidpath}")
-                    cap = cv2.VideoCapture(vidpath)
+                    cap = framecache.open_video(vidpath, cache, cache_scale, cache_hsv, index)
+                    tracker.hsv_input = framecache.is_hsv(cap)
+                    new_series = True
                     if cap is None or not cap.isOpened():
                         print(f"Error: Video file {vidpath} not openable!")
                         sys.exit(1)
                 elif pcs[0] == "echo":
                     print(line[6:])
                 elif pcs[0] == "xval":
-                    current_x = float(pcs[1])
+                    x_auto.current = float(pcs[1])
+                    new_series = True
                 elif pcs[0] == "xstep":
-                    x_step = float(pcs[1])
+                    x_auto.step = float(pcs[1])
+                    new_series = True
                 elif pcs[0] == "xoffset":
-                    offset = float(pcs[1])
+                    x_offset.value = float(pcs[1])
                 elif pcs[0] == "xnegate":
-                    negate = pcs[1].lower() != "false"
+                    x_negate.enabled = pcs[1].lower() != "false"
                 continue
             if cap is None:
                 print("Error: A video file must be specified first with !v <file> or !video <file>.")
                 sys.exit(1)
-            if pcs[0] == "~":
-                x_val = current_x
-                current_x += x_step
-            else:
-                x_val = float(pcs[0])
-            x_val -= offset
-            if negate:
-                x_val = -x_val
+            x_val = x_stages({"x": np.array([np.nan if pcs[0] == "~" else float(pcs[0])])})["x"][0]
             
             time_range = pcs[1]
             start, stop = time_range.split("-")
@@ -101,19 +176,51 @@ def main(times_in: pathlib.Path, data_out: TextIO, fx: float, fy: float, merge_t
             time = []
             angle = []
             while True:
-                success, img = cap.read()
+                success = tracker.read(cap)
                 ms = cap.get(cv2.CAP_PROP_POS_MSEC)
                 if not success or ms > stop:
                     break
-                ((x, y), (pivot_x, pivot_y)), _ = cvtrack.process_img(img, fx=fx, fy=fy)
+                bob, pivot = tracker.process()[0]
                 time.append(ms / 1000)
-                angle.append(math.atan2(x - pivot_x, y - pivot_y))
+                angle.append(cvtrack.angle(bob, pivot, correction, tracker.image.shape))
+            traces.append((x_val, np.array(time), np.array(angle)))
+            if save_traces is not None:
+                # Rewritten after every clip so the traces so far are kept if a later clip fails
+                save_trace_file(save_traces, traces)
+
+            if period_method == "spectral":
+                if plot:
+                    plt.scatter(time, angle)
+                    plt.show()
+                try:
+                    period, spectral_uncert = spectral.period(np.array(time), np.array(angle), min_period, max_period)
+                except ValueError as e:
+                    print(f"Error: {e} for range {start}ms to {stop}ms ({time_range}). Check your ranges?")
+                    sys.exit(1)
+                print(f"Spectral period of {period}s from {len(time)} samples")
+                pu = max(spectral_uncert, y_uncert, abs(period * y_rel_uncert))
+                xu = max(x_uncert, abs(x_rel_uncert * x_val))
+                data_out.write(f"{x_val} {period} {xu} {pu}\n")
+                continue
 
             peak_x, peak_y, peak_uncert = averaged_peaks(np.array(time), np.array(angle), merge_threshold, options=peak_options)
             if plot:
                 plt.scatter(time, angle)
                 plt.scatter(peak_x, peak_y)
                 plt.show()
+            if period_method == "fit" and len(peak_x) < 2:
+                print(f"Only {len(peak_x)} peaks found, seeding the fit from the periodogram")
+                try:
+                    seed, seed_uncert = spectral.period(np.array(time), np.array(angle), min_period, max_period)
+                except ValueError as e:
+                    print(f"Error: {e} for range {start}ms to {stop}ms ({time_range}). Check your ranges?")
+                    sys.exit(1)
+                if pcs[0] != "~" or new_series:
+                    series.append([])
+                series[-1].append((x_val, max(x_uncert, abs(x_rel_uncert * x_val)), (np.array(time), np.array(angle), None, seed),
+                                   (seed, max(seed_uncert, y_uncert, abs(seed * y_rel_uncert)))))
+                new_series = pcs[0] != "~"
+                continue
             if len(peak_x) < 2:
                 print(f"Error: Less than 2 peaks found for range {start}ms to {stop}ms ({time_range}). Check your ranges?")
                 sys.exit(1)
@@ -122,10 +229,34 @@ def main(times_in: pathlib.Path, data_out: TextIO, fx: float, fy: float, merge_t
             period_um = np.std(periods) / np.sqrt(len(periods))
             print(f"Averaged {len(peak_x)} peaks for a period of {period}s")
 
-            pu = max(period_um, period_uncert / (len(peak_x) - 1), y_uncert, abs(period * max(y_rel_uncert, max(u / t for u, t in zip(peak_uncert, peak_x)))))
+            # The mean of the differences only depends on the first and last peak, so include their timing uncertainty
+            timing_uncert = np.hypot(peak_uncert[0], peak_uncert[-1]) / (len(peak_x) - 1)
+            pu = max(period_um, period_uncert / (len(peak_x) - 1), y_uncert, abs(period * max(y_rel_uncert, max(u / t for u, t in zip(peak_uncert, peak_x)))),
+                     timing_uncert)
             xu = max(x_uncert, abs(x_rel_uncert * x_val))
+            if period_method == "fit":
+                # Explicit x values are fits of their own, ~ clips continue the current series
+                if pcs[0] != "~" or new_series:
+                    series.append([])
+                series[-1].append((x_val, xu, (np.array(time), np.array(angle), period, period), (period, pu)))
+                new_series = pcs[0] != "~"
+                continue
             data_out.write(f"{x_val} {period} {xu} {pu}\n")
 
+    if period_method == "fit":
+        print(f"Fitting {sum(len(clips) for clips in series)} clips in {len(series)} series")
+        with multiprocessing.Pool(processes) as pool:
+            fits = pool.map(_fit_series, [[clip for _, _, clip, _ in clips] for clips in series])
+        for clips, results in zip(series, fits):
+            for (x_val, xu, _, peak_result), (period, fit_stdev) in zip(clips, results):
+                if np.isnan(period):
+                    print(f"Warning: Fit failed for x={x_val}, using the period it was started from")
+                    period, pu = peak_result
+                else:
+                    print(f"Fitted a period of {period}s for x={x_val}")
+                    pu = max(fit_stdev, y_uncert, abs(period * y_rel_uncert))
+                data_out.write(f"{x_val} {period} {xu} {pu}\n")
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1 @@
+../resident.py
\ No newline at end of file
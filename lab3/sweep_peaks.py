@@ -0,0 +1,143 @@
+import ast
+import itertools
+import multiprocessing
+import click
+import numpy as np
+import pathlib
+from process_data import averaged_peaks, load_data
+from traces import load_trace_file
+from typing import Dict, List, Optional, TextIO, Tuple
+
+# Traces shared with the worker processes, set by _init_worker
+_traces = [] # type: List[Tuple[np.ndarray, np.ndarray]]
+
+
+def load_traces(paths: List[pathlib.Path]) -> Tuple[List[str], List[Tuple[np.ndarray, np.ndarray]]]:
+    """
+    Load traces saved by genperiod.py --save-traces (.npz, one trace per clip) or time vs angle files from gendata.py.
+    """
+    names = []
+    traces = []
+    for path in paths:
+        if path.suffix == ".npz":
+            for x, time, angle in load_trace_file(path):
+                names.append(f"{path.name}:{x:g}")
+                traces.append((time, angle))
+        else:
+            with path.open(encoding="utf-8") as f:
+                names.append(path.name)
+                traces.append(load_data(f))
+    return names, traces
+
+
+def peak_grid(merge_thresholds: List[float], peak_options: List[Tuple[str, str]]) -> List[Tuple[float, dict]]:
+    """
+    Every combination of merge threshold and find_peaks() option values. Options given more than once are swept
+    over all of their values.
+    """
+    values = {} # type: Dict[str, List]
+    for name, val in peak_options:
+        values.setdefault(name, []).append(ast.literal_eval(val))
+    names = list(values)
+    return [(m, dict(zip(names, combo))) for m in merge_thresholds for combo in itertools.product(*(values[n] for n in names))]
+
+
+def _init_worker(traces: List[Tuple[np.ndarray, np.ndarray]]) -> None:
+    global _traces
+    _traces = traces
+
+
+def _evaluate(args) -> Tuple[int, int, int, float, float, bool]:
+    """
+    Find the peaks of one trace with one setting. Returns the setting and trace indices, the number of peaks, the
+    period and its relative scatter from the maxima and minima together, and whether the peaks are valid.
+    """
+    setting, trace, merge_threshold, options, min_separation = args
+    time, angle = _traces[trace]
+    periods = []
+    count = 0
+    valid = True
+    for sign in (1, -1):
+        try:
+            peak_x, _, _ = averaged_peaks(time, sign * angle, merge_threshold, options=options)
+        except (TypeError, ValueError):
+            # Bad find_peaks() options, reported with a negative peak count
+            return setting, trace, -1, np.nan, np.nan, False
+        count += len(peak_x)
+        diffs = np.diff(peak_x)
+        # Like find_q.py, peaks this close together are noise rather than separate swings
+        if len(peak_x) < 2 or np.any(diffs < min_separation):
+            valid = False
+        periods.append(diffs)
+    periods = np.concatenate(periods)
+    if not len(periods):
+        return setting, trace, count, np.nan, np.nan, False
+    period = np.mean(periods)
+    return setting, trace, count, period, np.std(periods) / period, valid
+
+
+@click.command()
+@click.argument("traces_in", nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False, path_type=pathlib.Path))
+@click.option("--merge-threshold", "-m", multiple=True, type=click.FloatRange(min=0), help="Merge thresholds to try (default 0.25)")
+@click.option("--peak-option", "-p", multiple=True, type=(str, str), help="find_peaks() option and a value to try; give an option several times to sweep over its values")
+@click.option("--min-separation", type=click.FloatRange(min=0), default=0.5, help="Minimum time between peaks for them to be valid")
+@click.option("--processes", "-j", type=click.IntRange(min=1), default=None, help="Number of worker processes (default: one per CPU)")
+@click.option("--out", "-o", type=click.File("w", encoding="utf-8"), default=None, help="Also write the results as a table to a file")
+def main(traces_in: Tuple[pathlib.Path], merge_threshold: Tuple[float], peak_option: List[Tuple[str, str]], min_separation: float,
+         processes: Optional[int], out: Optional[TextIO]) -> None:
+    """
+    Sweep peak-processing settings over cached traces.
+
+    TRACES_IN are .npz files from genperiod.py --save-traces or time vs angle files from gendata.py. Every combination
+    of merge threshold and find_peaks() options is evaluated on every trace, and the settings are compared by how many
+    traces give valid peaks, how consistent the periods within a trace are, and how far the periods are from the
+    median over all valid settings.
+    """
+    names, traces = load_traces(list(traces_in))
+    settings = peak_grid(list(merge_threshold) or [0.25], peak_option)
+    print(f"Evaluating {len(settings)} settings on {len(traces)} traces")
+    jobs = [(s, t, m, options, min_separation) for s, (m, options) in enumerate(settings) for t in range(len(traces))]
+    counts = np.zeros((len(settings), len(traces)), dtype=int)
+    periods = np.full((len(settings), len(traces)), np.nan)
+    scatter = np.full((len(settings), len(traces)), np.nan)
+    valid = np.zeros((len(settings), len(traces)), dtype=bool)
+    with multiprocessing.Pool(processes, initializer=_init_worker, initargs=(traces,)) as pool:
+        for s, t, count, period, rel_scatter, ok in pool.imap_unordered(_evaluate, jobs, chunksize=max(len(jobs) // 64, 1)):
+            counts[s, t] = count
+            periods[s, t] = period
+            scatter[s, t] = rel_scatter
+            valid[s, t] = ok
+
+    # Consensus period of each trace from every valid setting
+    consensus = np.nanmedian(np.where(valid, periods, np.nan), axis=0) if valid.any() else np.full(len(traces), np.nan)
+    deviation = np.abs(periods - consensus) / consensus
+    header = "Setting\tValid\tPeaks (mean)\tScatter (mean)\tMax deviation\tFlags"
+    print()
+    print(header)
+    if out is not None:
+        out.write("# " + header.replace("\t", " | ") + "\n")
+    for s, (m, options) in enumerate(settings):
+        name = f"m={m:g} " + " ".join(f"{k}={v!r}" for k, v in options.items())
+        row_valid = valid[s]
+        if np.any(counts[s] < 0):
+            flags = "bad find_peaks() options"
+        elif not row_valid.all():
+            flags = "invalid: " + ", ".join(names[t] for t in np.flatnonzero(~row_valid))
+        else:
+            flags = ""
+        mean_scatter = np.mean(scatter[s, row_valid]) if row_valid.any() else np.nan
+        max_dev = np.nanmax(deviation[s, row_valid]) if row_valid.any() and not np.all(np.isnan(deviation[s, row_valid])) else np.nan
+        line = (f"{name.strip()}\t{np.count_nonzero(row_valid)}/{len(traces)}\t{np.mean(np.maximum(counts[s], 0)):.1f}\t{mean_scatter:.4g}\t{max_dev:.4g}\t{flags}")
+        print(line)
+        if out is not None:
+            out.write(line.replace("\t", " | ") + "\n")
+    best = [s for s in range(len(settings)) if valid[s].all()]
+    if best:
+        s = min(best, key=lambda s: np.mean(scatter[s]))
+        print(f"\nMost stable setting valid on every trace: m={settings[s][0]:g} {settings[s][1]}")
+    else:
+        print("\nNo setting gives valid peaks on every trace")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,24 @@
+"""
+Trace files written by genperiod.py --save-traces: the time and angle samples of each clip with its x value, in one
+.npz file.
+
+Only NumPy is imported here, so scripts which just read traces (e.g. sweep_peaks.py) don't load OpenCV and the rest
+of genperiod.py's dependencies, in every pool worker too.
+"""
+import pathlib
+from typing import List, Tuple
+
+import numpy as np
+
+
+def save_trace_file(path: pathlib.Path, traces: List[Tuple[float, np.ndarray, np.ndarray]]) -> None:
+    arrays = {"x": np.array([x for x, _, _ in traces])}
+    for i, (_, time, angle) in enumerate(traces):
+        arrays[f"time_{i}"] = time
+        arrays[f"angle_{i}"] = angle
+    np.savez(path, **arrays)
+
+
+def load_trace_file(path: pathlib.Path) -> List[Tuple[float, np.ndarray, np.ndarray]]:
+    with np.load(path) as data:
+        return [(x, data[f"time_{i}"], data[f"angle_{i}"]) for i, x in enumerate(data["x"])]
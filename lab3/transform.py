@@ -0,0 +1 @@
+../lab2/transform.py
\ No newline at end of file
@@ -0,0 +1 @@
+../vidindex.py
\ No newline at end of file
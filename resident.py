@@ -0,0 +1,96 @@
+"""
+Client for the resident analysis worker (worker.py).
+
+Scripts call forward(__name__) before importing anything heavy. If PHY180_WORKER is set to the socket of a running
+worker, the script's command line is run there instead, where NumPy, SciPy, OpenCV and matplotlib are already
+loaded. Its output is passed through as it is printed, and its exit code at the end. Otherwise (or if the worker
+can't be reached) the script carries on as normal. Once a job has been sent it is never run twice, so if the
+worker fails after that the script exits with an error instead.
+
+The worker draws plots headless, so scripts which show figures tell forward() and are only forwarded when
+plt.show() wouldn't open a window here either.
+
+Only the standard library is imported here, so checking for a worker costs next to nothing.
+"""
+import json
+import os
+import socket
+import sys
+from typing import Callable, Optional
+
+SOCKET_ENV = "PHY180_WORKER"
+# matplotlib backends which never open a window
+NON_INTERACTIVE = {"agg", "cairo", "pdf", "pgf", "ps", "svg", "template"}
+
+
+class WorkerError(Exception):
+    """
+    The worker was reached and given the job, but didn't send back a result.
+    """
+
+
+def request(job: dict, path: Optional[str] = None, on_output: Optional[Callable[[str, str], None]] = None) -> dict:
+    """
+    Send a job to the worker listening on path (by default from PHY180_WORKER) and wait for its result.
+
+    Output from a script is passed to on_output(stream, text) as it arrives, where stream is "stdout" or "stderr".
+    Raises OSError if the worker can't be reached, and WorkerError if it fails once the job has been sent.
+    """
+    path = path or os.environ.get(SOCKET_ENV)
+    if not path:
+        raise OSError(f"{SOCKET_ENV} is not set")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        try:
+            sock.sendall(json.dumps(job).encode("utf-8") + b"\n")
+            with sock.makefile("r", encoding="utf-8") as f:
+                for line in f:
+                    message = json.loads(line)
+                    if "stream" not in message:
+                        return message
+                    if on_output is not None:
+                        on_output(message["stream"], message["data"])
+        except (OSError, ValueError, KeyError) as e:
+            raise WorkerError(f"{type(e).__name__}: {e}") from e
+    raise WorkerError("Worker closed the connection without a result")
+
+
+def shows_figures() -> bool:
+    """
+    Whether plt.show() would open a window in this process, judged without importing matplotlib.
+    """
+    backend = os.environ.get("MPLBACKEND")
+    if backend:
+        return backend.lower() not in NON_INTERACTIVE
+    if sys.platform.startswith("linux"):
+        # matplotlib falls back to Agg without a display
+        return bool(os.environ.get("DISPLAY") or os.environ.get("WAYLAND_DISPLAY"))
+    return True
+
+
+def _write_output(stream: str, text: str) -> None:
+    out = sys.stderr if stream == "stderr" else sys.stdout
+    out.write(text)
+    out.flush()
+
+
+def forward(name: str, plots: bool = False) -> None:
+    """
+    Run the calling script on the resident worker and exit with its exit code, if name is "__main__" and a worker
+    is running. Scripts which will show figures pass plots=True, and are then run here unless that would be headless.
+    """
+    if name != "__main__" or not os.environ.get(SOCKET_ENV) or (plots and shows_figures()):
+        return
+    job = {"type": "run", "script": os.path.abspath(sys.argv[0]), "argv": sys.argv[1:], "cwd": os.getcwd()}
+    try:
+        result = request(job, on_output=_write_output)
+    except OSError:
+        # No worker, so run here
+        return
+    except WorkerError as e:
+        print(f"Worker error: {e}", file=sys.stderr)
+        sys.exit(1)
+    if "error" in result:
+        print(f"Worker error: {result['error']}", file=sys.stderr)
+        sys.exit(1)
+    sys.exit(result["returncode"])
@@ -0,0 +1,137 @@
+"""
+Quick scan of a video for the segments where the pendulum is swinging.
+
+Each frame is shrunk to a small greyscale thumbnail and compared with the previous one, counting the pixels which
+changed by more than a threshold. Runs of frames with enough changed pixels, with short gaps (such as the turning
+points of a swing) merged, are the motion segments; the start of a segment is the release point.
+
+The segments are written as a times file for lab3/genperiod.py, and gendata.py --segments tracks only within them,
+so full resolution tracking skips footage where the pendulum is at rest or being reset.
+"""
+import argparse
+import os
+from typing import List, TextIO, Tuple
+
+import cv2
+import numpy as np
+
+
+def motion_profile(cap: cv2.VideoCapture, width: int = 64, stride: int = 1, pixel_thresh: float = 25) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Return the time (in seconds) of every stride-th frame and the number of thumbnail pixels which changed since the
+    previous one by more than pixel_thresh grey levels.
+    """
+    times = []
+    changed = []
+    prev = None
+    while cap.grab():
+        for _ in range(stride - 1):
+            cap.grab()
+        success, frame = cap.retrieve()
+        if not success:
+            break
+        # Area averaging also averages out most of the sensor noise
+        height = max(round(frame.shape[0] * width / frame.shape[1]), 1)
+        thumb = cv2.cvtColor(cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY).astype(np.int16)
+        times.append(cap.get(cv2.CAP_PROP_POS_MSEC) / 1000)
+        changed.append(np.count_nonzero(np.abs(thumb - prev) > pixel_thresh) if prev is not None else 0)
+        prev = thumb
+    return np.array(times), np.array(changed)
+
+
+def find_segments(times: np.ndarray, changed: np.ndarray, min_pixels: int = 2, min_gap: float = 1.0,
+                  min_length: float = 5.0) -> List[Tuple[float, float]]:
+    """
+    Find the (start, stop) times of runs of frames with at least min_pixels changed, merging runs less than min_gap
+    seconds apart and dropping those shorter than min_length seconds.
+    """
+    moving = times[changed >= min_pixels]
+    if not len(moving):
+        return []
+    breaks = np.flatnonzero(np.diff(moving) > min_gap)
+    starts = moving[np.concatenate([[0], breaks + 1])]
+    stops = moving[np.concatenate([breaks, [len(moving) - 1]])]
+    return [(float(a), float(b)) for a, b in zip(starts, stops) if b - a >= min_length]
+
+
+def load_segments(file: TextIO) -> List[Tuple[float, float]]:
+    """
+    Load the time ranges (in ms) of the clips in a genperiod.py times file, ignoring directives.
+    """
+    segments = []
+    for line in file:
+        line = line.strip()
+        if not line or line.startswith("#") or line.startswith("!"):
+            continue
+        start, stop = line.split()[1].split("-")
+        segments.append((_parse_ms(start), _parse_ms(stop)))
+    return segments
+
+
+def _parse_ms(t: str, framerate: int = 30) -> float:
+    # Same formats as genperiod.parse_time
+    if t.endswith("s") and not t.endswith("ms"):
+        return float(t[:-1]) * 1000
+    if t.endswith("f"):
+        return int(t[:-1]) / framerate * 1000
+    if t.endswith("ms"):
+        t = t[:-2]
+    return float(t)
+
+
+def write_times_file(out_file: TextIO, vid_name: str, segments: List[Tuple[float, float]], settle: float,
+                     xval: float, xstep: float) -> None:
+    """
+    Write segments as a genperiod.py times file, with the video path relative to the file and settle seconds
+    dropped from the start of each segment to skip the release.
+    """
+    out_dir = os.path.dirname(os.path.abspath(out_file.name)) if os.path.exists(out_file.name) else os.getcwd()
+    try:
+        vid_path = os.path.relpath(vid_name, out_dir)
+    except ValueError:
+        vid_path = os.path.abspath(vid_name)
+    out_file.write("# Motion segments found by scan_motion.py; fill in the x values or set !xval and !xstep\n")
+    out_file.write(f"!v {vid_path}\n!xval {xval}\n!xstep {xstep}\n")
+    for start, stop in segments:
+        out_file.write(f"# released at {start:.2f}s\n")
+        out_file.write(f"~ {round((start + settle) * 1000)}-{round(stop * 1000)}\n")
+
+
+def main(vid_name: str, out_file: TextIO, width: int, stride: int, pixel_thresh: float, min_pixels: int,
+         min_gap: float, min_length: float, settle: float, xval: float, xstep: float) -> None:
+    cap = cv2.VideoCapture(vid_name)
+    if not cap.isOpened():
+        print(f"Error: Video file {vid_name} not openable!")
+        out_file.close()
+        return
+    times, changed = motion_profile(cap, width, stride, pixel_thresh)
+    cap.release()
+    segments = [(start, stop) for start, stop in find_segments(times, changed, min_pixels, min_gap, min_length) if stop - start > settle]
+    print(f"Scanned {len(times)} frames ({times[-1] if len(times) else 0:.1f}s), found {len(segments)} segments")
+    print("Release (s)\tEnd (s)\tLength (s)")
+    for start, stop in segments:
+        print(f"{start:.2f}\t\t{stop:.2f}\t{stop - start:.2f}")
+    if len(times):
+        moving = sum(stop - start for start, stop in segments)
+        print(f"{moving / (times[-1] - times[0] or 1):.0%} of the video is in a segment")
+    write_times_file(out_file, vid_name, segments, settle, xval, xstep)
+    out_file.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find the segments of a video where the pendulum is swinging and write them as a genperiod.py times file.")
+    parser.add_argument("vid_name", type=str)
+    parser.add_argument("out_file", type=argparse.FileType("w", encoding="utf-8"))
+    parser.add_argument("--width", type=int, default=64, help="Width of the thumbnails in pixels")
+    parser.add_argument("--stride", type=int, default=1, help="Compare every nth frame only; the other frames are still decoded but not converted")
+    parser.add_argument("--pixel-thresh", type=float, default=25, help="Change in grey level for a thumbnail pixel to count as changed")
+    parser.add_argument("--min-pixels", type=int, default=2, help="Number of changed thumbnail pixels for a frame to count as moving")
+    parser.add_argument("--min-gap", type=float, default=1.0, help="Merge moving spans less than this many seconds apart; should be longer than the pause at a turning point")
+    parser.add_argument("--min-length", type=float, default=5.0, help="Shortest segment to keep in seconds")
+    parser.add_argument("--settle", type=float, default=1.0, help="Seconds to drop from the start of each segment in the times file, to skip the release")
+    parser.add_argument("--xval", type=float, default=0, help="First x value for the times file")
+    parser.add_argument("--xstep", type=float, default=1, help="Step between x values for the times file")
+    args = parser.parse_args()
+    if args.width < 4 or args.stride < 1:
+        parser.error("--width must be at least 4 and --stride at least 1")
+    main(**vars(args))
@@ -0,0 +1,127 @@
+"""
+Parallel tracking of a single video with one decoder and several tracker processes.
+
+The decoder decodes frames straight into slots of a shared memory ring buffer. Tracker processes claim filled slots,
+track them and hand the slot back, sending only the resulting angle back to the parent. Results are put back in frame
+order before being returned, so the output is identical to tracking sequentially.
+"""
+import multiprocessing
+import threading
+from multiprocessing import shared_memory
+from typing import Iterator, Optional, Tuple
+
+import cv2
+import numpy as np
+
+import cvtrack
+
+
+def _track_slots(shm_name: str, shape: Tuple[int, ...], n_slots: int, filled: multiprocessing.Queue, free: multiprocessing.Queue,
+                 results: multiprocessing.Queue, correction: Optional[cvtrack.Correction], tracker_args: dict) -> None:
+    shm = shared_memory.SharedMemory(name=shm_name)
+    slots = np.ndarray((n_slots, *shape), dtype=np.uint8, buffer=shm.buf)
+    tracker = cvtrack.Tracker(**tracker_args)
+    try:
+        while True:
+            item = filled.get()
+            if item is None:
+                break
+            slot, seq, t = item
+            try:
+                bob, pivot = tracker.process(slots[slot])[0]
+                results.put((seq, t, cvtrack.angle(bob, pivot, correction, tracker.image.shape), None))
+            except ValueError as e:
+                results.put((seq, t, None, str(e)))
+            finally:
+                free.put(slot)
+    finally:
+        results.put(None)
+        del slots
+        shm.close()
+
+
+def _decode(cap: cv2.VideoCapture, slots: np.ndarray, filled: multiprocessing.Queue, free: multiprocessing.Queue, skip_frames: int,
+            workers: int, stop: threading.Event) -> None:
+    # The first frame was queued before the decoder started
+    seq = 1
+    try:
+        while not stop.is_set():
+            # Blocks until a tracker hands a slot back, which keeps the decoder from running ahead
+            slot = free.get()
+            success, img = cap.read(slots[slot])
+            if not success:
+                break
+            if not np.shares_memory(img, slots[slot]):
+                # The backend allocated its own image instead of decoding into the slot
+                slots[slot] = img
+            filled.put((slot, seq, cap.get(cv2.CAP_PROP_POS_MSEC) / 1000))
+            seq += 1
+            for _ in range(skip_frames):
+                cap.grab()
+    finally:
+        for _ in range(workers):
+            filled.put(None)
+
+
+def track_parallel(cap: cv2.VideoCapture, workers: int, slots: Optional[int] = None, skip_frames: int = 0,
+                   correction: Optional[cvtrack.Correction] = None, **tracker_args) -> Iterator[Tuple[float, float]]:
+    """
+    Track every (skip_frames + 1)th frame of cap using a number of tracker processes, yielding (time, angle) in frame order.
+
+    correction is applied to the tracked positions, and tracker_args are passed to cvtrack.Tracker in each process. Tracking failures are raised as a ValueError.
+    """
+    success, first = cap.read()
+    if not success:
+        return
+    n_slots = slots or 2 * workers
+    shm = shared_memory.SharedMemory(create=True, size=n_slots * first.nbytes)
+    buffers = np.ndarray((n_slots, *first.shape), dtype=np.uint8, buffer=shm.buf)
+    filled = multiprocessing.Queue()
+    free = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    # The first frame was read to find the frame size, so it goes into the first slot
+    buffers[0] = first
+    filled.put((0, 0, cap.get(cv2.CAP_PROP_POS_MSEC) / 1000))
+    for _ in range(skip_frames):
+        cap.grab()
+    for slot in range(1, n_slots):
+        free.put(slot)
+
+    procs = [multiprocessing.Process(target=_track_slots, args=(shm.name, first.shape, n_slots, filled, free, results, correction, tracker_args), daemon=True)
+             for _ in range(workers)]
+    for proc in procs:
+        proc.start()
+    stop = threading.Event()
+    # Decoding releases the GIL, so a thread is enough to keep it running while results are collected here
+    decoder = threading.Thread(target=_decode, args=(cap, buffers, filled, free, skip_frames, workers, stop), daemon=True)
+    decoder.start()
+
+    pending = {}
+    next_seq = 0
+    finished = 0
+    try:
+        while finished < workers:
+            item = results.get()
+            if item is None:
+                finished += 1
+                continue
+            seq, t, angle, error = item
+            if error is not None:
+                raise ValueError(error)
+            pending[seq] = (t, angle)
+            while next_seq in pending:
+                yield pending.pop(next_seq)
+                next_seq += 1
+    finally:
+        stop.set()
+        # Make sure the decoder isn't stuck waiting for a slot
+        for slot in range(n_slots):
+            free.put(slot)
+        decoder.join()
+        for proc in procs:
+            proc.join(timeout=1)
+            if proc.is_alive():
+                proc.terminate()
+        del buffers
+        shm.close()
+        shm.unlink()
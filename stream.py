@@ -0,0 +1,180 @@
+import argparse
+import math
+import queue
+import threading
+import time
+from typing import Optional, TextIO, Tuple, Union
+
+import cv2
+import numpy as np
+from scipy import signal
+
+import cvtrack
+
+DROP_POLICIES = ("oldest", "newest", "block")
+
+
+class RingBuffer:
+    """
+    Fixed-size buffer of the most recent (time, angle) samples.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.times = np.zeros(size)
+        self.angles = np.zeros(size)
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def append(self, t: float, angle: float) -> None:
+        with self.lock:
+            i = self.count % self.size
+            self.times[i] = t
+            self.angles[i] = angle
+            self.count += 1
+
+    def snapshot(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Return copies of the stored samples in chronological order.
+        """
+        with self.lock:
+            if self.count <= self.size:
+                return self.times[:self.count].copy(), self.angles[:self.count].copy()
+            i = self.count % self.size
+            return np.roll(self.times, -i), np.roll(self.angles, -i)
+
+
+def readout(times: np.ndarray, angles: np.ndarray) -> Optional[Tuple[float, float]]:
+    """
+    Estimate the period and amplitude from the recent samples, or None if there are not enough peaks.
+    """
+    maxima, _ = signal.find_peaks(angles, height=0)
+    minima, _ = signal.find_peaks(-angles, height=0)
+    if len(maxima) < 2:
+        return None
+    period = float(np.mean(np.diff(times[maxima])))
+    amplitude = float(np.mean(angles[maxima]) - np.mean(angles[minima])) / 2 if len(minima) else float(np.mean(angles[maxima]))
+    return period, amplitude
+
+
+def capture(cap: cv2.VideoCapture, frames: "queue.Queue", policy: str, replay: bool, stats: dict, stop: threading.Event) -> None:
+    fps = cap.get(cv2.CAP_PROP_FPS) or 30
+    start = time.perf_counter()
+    n = 0
+    while not stop.is_set():
+        if replay:
+            # Pace a file source at its native frame rate so it behaves like a camera
+            delay = start + n / fps - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        success, img = cap.read()
+        if not success:
+            break
+        n += 1
+        stats["captured"] += 1
+        captured = time.perf_counter()
+        # Prefer the source's own timestamps; cameras that don't provide them fall back to the wall clock
+        ms = cap.get(cv2.CAP_PROP_POS_MSEC)
+        t = ms / 1000 if ms > 0 else captured - start
+        item = (t, captured, img)
+        if policy == "block":
+            frames.put(item)
+            continue
+        try:
+            frames.put_nowait(item)
+        except queue.Full:
+            stats["dropped"] += 1
+            if policy == "oldest":
+                try:
+                    frames.get_nowait()
+                except queue.Empty:
+                    pass
+                frames.put_nowait(item)
+    frames.put(None)
+
+
+def main(source: Union[int, str], out_file: Optional[TextIO], fx: Optional[float], fy: Optional[float], detector: str, coarse: Optional[float], queue_size: int, drop: str,
+         max_latency: float, buffer_size: int, readout_interval: float, replay: bool) -> None:
+    cap = cv2.VideoCapture(source)
+    if not cap.isOpened():
+        print(f"Error: Cannot open source {source}")
+        return
+    frames = queue.Queue(maxsize=queue_size)
+    stats = {"captured": 0, "dropped": 0, "late": 0, "failed": 0}
+    stop = threading.Event()
+    thread = threading.Thread(target=capture, args=(cap, frames, drop, replay, stats, stop), daemon=True)
+    buffer = RingBuffer(buffer_size)
+    # Frames are queued so they can't share a buffer, but the tracking buffers can be reused
+    tracker = cvtrack.Tracker(fx=fx, fy=fy, raise_on_fail=False, detector=detector, coarse=coarse)
+    latencies = []
+    last_readout = time.perf_counter()
+    thread.start()
+    try:
+        while True:
+            item = frames.get()
+            if item is None:
+                break
+            t, captured, img = item
+            # Frames that waited too long in the queue are stale by the time we'd publish them
+            if max_latency is not None and (time.perf_counter() - captured) * 1000 > max_latency:
+                stats["late"] += 1
+                continue
+            ((x, y), (pivot_x, pivot_y)), _ = tracker.process(img)
+            if x is None or pivot_x is None:
+                stats["failed"] += 1
+                continue
+            angle = math.atan2(x - pivot_x, y - pivot_y)
+            latencies.append((time.perf_counter() - captured) * 1000)
+            buffer.append(t, angle)
+            if out_file is not None:
+                out_file.write(f"{t} {angle}\n")
+            if time.perf_counter() - last_readout >= readout_interval:
+                last_readout = time.perf_counter()
+                result = readout(*buffer.snapshot())
+                status = f"period {result[0]:.4f}s, amplitude {result[1]:.4f}rad" if result is not None else "waiting for peaks"
+                print(f"t={t:.2f}s angle={angle:.4f} {status} latency={latencies[-1]:.1f}ms")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        # Unblock the capture thread if it is waiting on a full queue
+        try:
+            while True:
+                frames.get_nowait()
+        except queue.Empty:
+            pass
+        thread.join(timeout=1)
+        cap.release()
+        if out_file is not None:
+            out_file.close()
+
+    print(f"Captured {stats['captured']} frames, tracked {len(latencies)}")
+    print(f"Dropped {stats['dropped']} (queue full), {stats['late']} (over latency limit), {stats['failed']} (tracking failed)")
+    if latencies:
+        lat = np.array(latencies)
+        print(f"Latency: mean {lat.mean():.1f}ms, p95 {np.percentile(lat, 95):.1f}ms, max {lat.max():.1f}ms")
+
+
+def parse_source(s: str) -> Union[int, str]:
+    # Integers are camera indices, anything else is a file path or URL
+    try:
+        return int(s)
+    except ValueError:
+        return s
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Track a live video source and report period and amplitude as it runs")
+    parser.add_argument("source", type=parse_source, help="Camera index, video file or stream URL")
+    parser.add_argument("out_file", type=argparse.FileType("w", encoding="utf-8"), nargs="?", default=None)
+    parser.add_argument("--fx", type=float, default=None)
+    parser.add_argument("--fy", type=float, default=None)
+    parser.add_argument("--detector", choices=cvtrack.DETECTORS.keys(), default="contour")
+    parser.add_argument("--coarse", type=float, default=None, help="Find targets on a frame downscaled by this factor, then refine at full resolution")
+    parser.add_argument("--queue-size", type=int, default=4, help="Frames buffered between capture and tracking")
+    parser.add_argument("--drop", choices=DROP_POLICIES, default="oldest", help="Which frame to drop when tracking falls behind")
+    parser.add_argument("--max-latency", type=float, default=None, help="Skip frames that waited longer than this many ms")
+    parser.add_argument("--buffer-size", type=int, default=1024, help="Number of recent samples kept for the readout")
+    parser.add_argument("--readout-interval", type=float, default=1.0, help="Seconds between readouts")
+    parser.add_argument("--replay", action="store_true", help="Replay a video file at its native frame rate as a stand-in live source")
+    main(**vars(parser.parse_args()))
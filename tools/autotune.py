@@ -0,0 +1,164 @@
+import time
+import click
+import cv2
+import cvtrack
+import numpy as np
+import spectral
+from typing import List, Tuple
+
+
+def load_segment(cap: cv2.VideoCapture, start: float, duration: float) -> Tuple[List[np.ndarray], np.ndarray, float, float]:
+    """
+    Decode duration seconds of video from start (both in seconds) into memory.
+
+    Returns the frames, their times, and the mean time to read (decode) and to grab (skip) one frame.
+    """
+    frames = []
+    times = []
+    cap.set(cv2.CAP_PROP_POS_MSEC, start * 1000)
+    read_start = time.perf_counter()
+    while True:
+        success, frame = cap.read()
+        ms = cap.get(cv2.CAP_PROP_POS_MSEC)
+        if not success or ms > (start + duration) * 1000:
+            break
+        frames.append(frame)
+        times.append(ms / 1000)
+    read_time = (time.perf_counter() - read_start) / max(len(frames), 1)
+
+    cap.set(cv2.CAP_PROP_POS_MSEC, start * 1000)
+    grab_start = time.perf_counter()
+    for _ in range(len(frames)):
+        cap.grab()
+    grab_time = (time.perf_counter() - grab_start) / max(len(frames), 1)
+    return frames, np.array(times), read_time, grab_time
+
+
+def track_frames(frames: List[np.ndarray], scale: float) -> Tuple[np.ndarray, float]:
+    """
+    Track frames at a scale, returning the angles (NaN where a target was not found) and the time taken.
+    """
+    tracker = cvtrack.Tracker(fx=scale if scale != 1 else None, fy=scale if scale != 1 else None, raise_on_fail=False)
+    angles = np.empty(len(frames))
+    start = time.perf_counter()
+    for i, frame in enumerate(frames):
+        (bob, pivot), _ = tracker.process(frame)
+        angles[i] = cvtrack.angle(bob, pivot) if bob[0] is not None and pivot[0] is not None else np.nan
+    return angles, time.perf_counter() - start
+
+
+@click.command()
+@click.argument("vid_name", type=click.Path(exists=True, readable=True))
+@click.option("--segments", "-n", type=click.IntRange(min=1), default=3, help="Number of segments to sample, spread evenly through the video")
+@click.option("--start", "-t", "starts", multiple=True, type=click.FloatRange(min=0), help="Start time of a segment in seconds; give several times to choose the segments instead of spreading them evenly")
+@click.option("--min-amplitude", type=click.FloatRange(min=0), default=0.02, help="Skip segments where the pendulum swings less than this (in radians), such as while it is at rest or being reset")
+@click.option("--duration", "-d", type=click.FloatRange(min=0, min_open=True), default=10, help="Length of each segment in seconds; should cover a few periods")
+@click.option("--scale", "-s", "scales", multiple=True, type=click.FloatRange(min=0, min_open=True, max=1), help="Scale factors (--fx/--fy) to try (default 1, 0.75, 0.5, 0.35, 0.25)")
+@click.option("--skip", "-k", "skips", multiple=True, type=click.IntRange(min=0), help="Values of --skip-frames to try (default 0, 1, 2, 3, 5)")
+@click.option("--angle-tol", type=click.FloatRange(min=0), default=0.005, help="Maximum angle deviation from the reference in radians")
+@click.option("--period-tol", type=click.FloatRange(min=0), default=1e-3, help="Maximum relative period deviation from the reference")
+@click.option("--repeat", "-r", type=click.IntRange(min=1), default=3, help="Number of timing repetitions")
+def main(vid_name: str, segments: int, starts: Tuple[float], min_amplitude: float, duration: float, scales: Tuple[float],
+         skips: Tuple[int], angle_tol: float, period_tol: float, repeat: int) -> None:
+    """
+    Find the fastest tracking settings for VID_NAME that meet a precision target.
+
+    Every combination of scale and frame skip is run on short segments of the video and compared to tracking every
+    frame at full resolution, by the angle at each tracked frame and the (Lomb-Scargle) period of each segment.
+    Segments where the reference shows no real swing are skipped, since they have no meaningful period.
+    Throughput counts decoding the tracked frames and grabbing the skipped ones, as gendata.py does.
+    """
+    scales = sorted(scales or (1, 0.75, 0.5, 0.35, 0.25), reverse=True)
+    skips = sorted(skips or (0, 1, 2, 3, 5))
+    cap = cv2.VideoCapture(vid_name)
+    length = cap.get(cv2.CAP_PROP_FRAME_COUNT) / (cap.get(cv2.CAP_PROP_FPS) or 30)
+    if not starts:
+        starts = np.linspace(0, max(length - duration, 0), segments)
+
+    # Segments are handled one at a time, keeping only the angles and timings, since the decoded frames of high
+    # resolution footage take gigabytes
+    segment_times = [] # type: List[np.ndarray]
+    reference = [] # type: List[np.ndarray]
+    read_times = []
+    grab_times = []
+    # Angles of every frame of each segment at each scale; each skip then uses a subset of them
+    angles = {scale: [] for scale in scales} # type: dict
+    track_elapsed = {scale: 0.0 for scale in scales} # type: dict
+    n_frames = 0
+    for start in starts:
+        frames, times, read_time, grab_time = load_segment(cap, start, duration)
+        if len(frames) < 8:
+            continue
+        # Reference tracking of every frame at full resolution
+        ref = track_frames(frames, 1)[0]
+        found = ref[~np.isnan(ref)]
+        # The smaller of the swings in each half, so segments where the pendulum starts or stops part way are skipped too
+        amplitude = min((h.max() - h.min()) / 2 for h in np.array_split(found, 2)) if len(found) >= 8 else 0.0
+        if amplitude < min_amplitude:
+            print(f"Skipping the segment at {start:g}s: swing amplitude {amplitude:.3g} rad is below --min-amplitude")
+            continue
+        for scale in scales:
+            best = None
+            for _ in range(repeat):
+                seg_angles, elapsed = track_frames(frames, scale)
+                best = elapsed if best is None else min(best, elapsed)
+            angles[scale].append(seg_angles)
+            track_elapsed[scale] += best
+        n_frames += len(frames)
+        segment_times.append(times)
+        reference.append(ref)
+        read_times.append(read_time)
+        grab_times.append(grab_time)
+        del frames
+    cap.release()
+    if not segment_times:
+        print("Error: No segment of the video could be read with the pendulum swinging; choose some with --start")
+        return
+    read_time = float(np.mean(read_times))
+    grab_time = float(np.mean(grab_times))
+    track_times = {scale: elapsed / n_frames for scale, elapsed in track_elapsed.items()}
+    print(f"Tracked {len(segment_times)} segments of {duration}s; {read_time * 1000:.2f}ms to read and {grab_time * 1000:.2f}ms to skip a frame")
+
+    ref_periods = []
+    for times, ref in zip(segment_times, reference):
+        found = ~np.isnan(ref)
+        ref_periods.append(spectral.period(times[found], ref[found])[0] if np.count_nonzero(found) >= 4 else np.nan)
+
+    print("Scale\tSkip\tFrames/s\tMax angle dev (rad)\tMax period dev\tMissed\tOK")
+    candidates = [] # type: List[Tuple[float, float, int]]
+    for scale in scales:
+        for skip in skips:
+            # Average cost per frame of video: every (skip + 1)th frame is read and tracked, the rest are grabbed
+            per_frame = (read_time + track_times[scale] + skip * grab_time) / (skip + 1)
+            angle_dev = 0.0
+            period_dev = 0.0
+            missed = 0
+            for times, ref, ref_period, seg_angles in zip(segment_times, reference, ref_periods, angles[scale]):
+                sub = seg_angles[::skip + 1]
+                sub_ref = ref[::skip + 1]
+                sub_times = times[::skip + 1]
+                found = ~np.isnan(sub)
+                missed += np.count_nonzero(~found & ~np.isnan(sub_ref))
+                both = found & ~np.isnan(sub_ref)
+                if np.any(both):
+                    angle_dev = max(angle_dev, float(np.max(np.abs(sub[both] - sub_ref[both]))))
+                if np.count_nonzero(found) >= 4 and not np.isnan(ref_period):
+                    period_dev = max(period_dev, abs(spectral.period(sub_times[found], sub[found])[0] - ref_period) / ref_period)
+                else:
+                    period_dev = np.inf
+            ok = not missed and angle_dev <= angle_tol and period_dev <= period_tol
+            print(f"{scale:g}\t{skip}\t{1 / per_frame:.1f}\t\t{angle_dev:.2e}\t\t{period_dev:.2e}\t{missed}\t{'yes' if ok else 'no'}")
+            if ok:
+                candidates.append((per_frame, scale, skip))
+    if candidates:
+        _, scale, skip = min(candidates)
+        scale_args = f"--fx {scale:g} --fy {scale:g} " if scale != 1 else ""
+        print(f"Recommended for gendata.py: {scale_args}--skip-frames {skip}")
+        if scale != 1:
+            print(f"Recommended for lab3/genperiod.py: {scale_args.strip()}")
+    else:
+        print("No setting meets the precision target; track every frame at full resolution (--skip-frames 0)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+import time
+import click
+import cv2
+import cvtrack
+import numpy as np
+from typing import Dict, List, Optional
+
+
+@click.command()
+@click.argument("vid_name", type=click.Path(exists=True, readable=True))
+@click.option("--samples", "-n", type=click.IntRange(min=1), default=100, help="Number of frames to sample across the video")
+@click.option("--fx", type=click.FloatRange(min=0, min_open=True), default=None, help="X scaling factor")
+@click.option("--fy", type=click.FloatRange(min=0, min_open=True), default=None, help="Y scaling factor")
+@click.option("--tolerance", "-t", type=click.FloatRange(min=0), default=1.0, help="Maximum centroid deviation from the contour detector in pixels")
+@click.option("--repeat", "-r", type=click.IntRange(min=1), default=5, help="Number of timing repetitions")
+def main(vid_name: str, samples: int, fx: Optional[float], fy: Optional[float], tolerance: float, repeat: int) -> None:
+    """
+    Benchmark the blob detector backends in cvtrack on frames from VID_NAME.
+
+    The contour detector is used as the reference, and the fastest backend that finds both targets wherever the
+    reference does and stays within the tolerance is recommended.
+    """
+    cap = cv2.VideoCapture(vid_name)
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    masks = [] # type: List[np.ndarray]
+    for frame_no in np.linspace(0, max(frame_count - 1, 0), samples, dtype=int):
+        cap.set(cv2.CAP_PROP_POS_FRAMES, frame_no)
+        success, img = cap.read()
+        if not success:
+            continue
+        _, (binary, green_binary) = cvtrack.process_img(img, fx=fx, fy=fy, raise_on_fail=False)
+        masks.extend((binary, green_binary))
+    cap.release()
+    print(f"Loaded {len(masks) // 2} frames")
+
+    reference = [cvtrack.detect_contour(m) for m in masks]
+    timings = {} # type: Dict[str, float]
+    print("Detector\tus/mask\tMax dev (px)\tMissed\tMean confidence")
+    for name, detector in cvtrack.DETECTORS.items():
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            detections = [detector(m) for m in masks]
+            best = min(best, time.perf_counter() - start)
+        deviations = [np.hypot(d.x - r.x, d.y - r.y) for d, r in zip(detections, reference) if d is not None and r is not None]
+        missed = sum(d is None and r is not None for d, r in zip(detections, reference))
+        confidence = np.mean([d.confidence for d in detections if d is not None]) if any(d is not None for d in detections) else 0
+        max_dev = max(deviations, default=0.0)
+        print(f"{name}\t{best / len(masks) * 1e6:.1f}\t{max_dev:.2f}\t\t{missed}\t{confidence:.3f}")
+        if not missed and max_dev <= tolerance:
+            timings[name] = best
+    if timings:
+        print(f"Recommended detector: {min(timings, key=timings.get)}")
+    else:
+        print("No detector is accurate enough; use contour")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+import itertools
+import sys
+import click
+import cv2
+import cvtrack
+import numpy as np
+from typing import List, Optional, Tuple
+
+
+def load_images(source: str, samples: int) -> List[np.ndarray]:
+    img = cv2.imread(source)
+    if img is not None:
+        return [img]
+    cap = cv2.VideoCapture(source)
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    images = []
+    for frame_no in np.linspace(0, max(frame_count - 1, 0), samples, dtype=int):
+        cap.set(cv2.CAP_PROP_POS_FRAMES, frame_no)
+        success, img = cap.read()
+        if success:
+            images.append(img)
+    return images
+
+
+def find_corners(img: np.ndarray, board: Tuple[int, int]) -> Optional[np.ndarray]:
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    found, corners = cv2.findChessboardCorners(gray, board)
+    if not found:
+        return None
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001)
+    return cv2.cornerSubPix(gray, corners, (11, 11), (-1, -1), criteria)
+
+
+def align_homography(homography: np.ndarray, center: Tuple[float, float]) -> np.ndarray:
+    """
+    Rotate/flip and scale the board coordinates so that near the image center they point the same way as the image
+    axes (x right, y down) with about the same scale, so angles keep the same sign convention as uncorrected ones.
+    """
+    pts = np.array([[center, (center[0] + 1, center[1]), (center[0], center[1] + 1)]], dtype=np.float64)
+    o, px, py = cv2.perspectiveTransform(pts, homography)[0]
+    dx, dy = px - o, py - o
+    best = None
+    # Try all 8 axis-aligned rotations and reflections
+    for swap, sx, sy in itertools.product((False, True), (1, -1), (1, -1)):
+        m = np.array([[0, 1], [1, 0]] if swap else [[1, 0], [0, 1]], dtype=np.float64) * [[sx], [sy]]
+        score = (m @ dx)[0] + (m @ dy)[1]
+        if best is None or score > best[0]:
+            best = (score, m)
+    scale = 2 / (np.linalg.norm(dx) + np.linalg.norm(dy))
+    align = np.eye(3)
+    align[:2, :2] = best[1] * scale
+    # Keep the image center where it was
+    align[:2, 2] = np.array(center) - align[:2, :2] @ o
+    return align @ homography
+
+
+@click.command()
+@click.argument("sources", nargs=-1, required=True)
+@click.option("--plane", "-p", required=True, help="Image or video with the board held in the plane of the swing")
+@click.option("--board", "-b", nargs=2, type=int, default=(9, 6), help="Number of inner corners of the chessboard (columns, rows)")
+@click.option("--samples", "-n", type=click.IntRange(min=1), default=30, help="Frames to sample from each calibration video")
+@click.option("--out", "-o", type=click.Path(writable=True), default="correction.npz", help="Output correction file")
+def main(sources: List[str], plane: str, board: Tuple[int, int], samples: int, out: str) -> None:
+    """
+    Calibrate the camera from images or videos of a chessboard (SOURCES), and find the homography to the plane of the
+    swing from an image of the board held in that plane.
+
+    The output can be passed to gendata.py and genperiod.py with --correction.
+    """
+    grid = np.zeros((board[0] * board[1], 3), np.float32)
+    grid[:, :2] = np.mgrid[0:board[0], 0:board[1]].T.reshape(-1, 2)
+
+    object_points = []
+    image_points = []
+    size = None
+    for source in sources:
+        for img in load_images(source, samples):
+            size = (img.shape[1], img.shape[0])
+            corners = find_corners(img, board)
+            if corners is not None:
+                object_points.append(grid)
+                image_points.append(corners)
+    print(f"Found the board in {len(image_points)} images")
+    if len(image_points) < 3:
+        print("Error: At least 3 views of the board are needed.")
+        sys.exit(1)
+    rms, camera_matrix, dist_coeffs, _, _ = cv2.calibrateCamera(object_points, image_points, size, None, None)
+    print(f"Reprojection error: {rms:.3f}px")
+
+    plane_imgs = load_images(plane, 1)
+    corners = find_corners(plane_imgs[0], board) if plane_imgs else None
+    if corners is None:
+        print("Error: Board not found in the plane image.")
+        sys.exit(1)
+    if (plane_imgs[0].shape[1], plane_imgs[0].shape[0]) != size:
+        print("Error: The plane image must have the same resolution as the calibration images.")
+        sys.exit(1)
+    undistorted = cv2.undistortPoints(corners, camera_matrix, dist_coeffs, P=camera_matrix)
+    homography, _ = cv2.findHomography(undistorted, grid[:, :2])
+    homography = align_homography(homography, (size[0] / 2, size[1] / 2))
+
+    cvtrack.Correction(camera_matrix, dist_coeffs, homography, size).save(out)
+    print(f"Correction written to {out}")
+
+
+if __name__ == "__main__":
+    main()
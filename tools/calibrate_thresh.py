@@ -0,0 +1,139 @@
+import itertools
+import multiprocessing
+import sys
+import click
+import cv2
+import cvtrack
+import numpy as np
+from typing import List, Optional, Tuple
+
+# Candidate half-widths of the hue window and lower saturation/value bounds to search
+HUE_WIDTHS = (4, 6, 8, 10, 12, 15)
+SAT_LOWS = (50, 75, 100, 125, 150)
+VAL_LOWS = (50, 80, 110, 140)
+# How far the histogram peak is allowed to be from the hue of the starting threshold
+HUE_SEARCH = 15
+
+_cap = None # type: cv2.VideoCapture
+_scale = None # type: Optional[float]
+
+
+def _init_worker(vid_name: str, scale: Optional[float]) -> None:
+    global _cap, _scale
+    _cap = cv2.VideoCapture(vid_name)
+    _scale = scale
+
+
+def _load_frame(frame_no: int) -> Optional[np.ndarray]:
+    _cap.set(cv2.CAP_PROP_POS_FRAMES, frame_no)
+    success, img = _cap.read()
+    if not success:
+        return None
+    if _scale is not None:
+        img = cv2.resize(img, None, fx=_scale, fy=_scale, interpolation=cv2.INTER_AREA)
+    return cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
+
+
+def hue_center(thresh: Tuple[cvtrack.HSV, cvtrack.HSV]) -> int:
+    low, high = thresh[0][0], thresh[1][0]
+    if low > high:
+        high += 180
+    return (low + high) // 2 % 180
+
+
+def hue_histogram(frames: List[np.ndarray], sat_low: int, val_low: int) -> np.ndarray:
+    hist = np.zeros(180)
+    for hsv in frames:
+        mask = cv2.inRange(hsv, (0, sat_low, val_low), (180, 255, 255))
+        hist += cv2.calcHist([hsv], [0], mask, [180], [0, 180]).ravel()
+    return hist
+
+
+def find_peak(hist: np.ndarray, seed: int) -> int:
+    # Search circularly around the seed since hue wraps around at 180
+    offsets = np.arange(-HUE_SEARCH, HUE_SEARCH + 1)
+    hues = (seed + offsets) % 180
+    return int(hues[np.argmax(hist[hues])])
+
+
+def score_frame(binary: np.ndarray) -> Tuple[float, int]:
+    """
+    Score how well a mask isolates exactly one compact blob.
+
+    Returns the score in [0, 1] and the area of the largest blob.
+    """
+    n, _, stats, _ = cv2.connectedComponentsWithStats(binary, connectivity=8)
+    if n <= 1:
+        return 0.0, 0
+    areas = stats[1:, cv2.CC_STAT_AREA]
+    i = np.argmax(areas)
+    largest = areas[i]
+    # Fraction of the mask belonging to the largest blob
+    purity = largest / areas.sum()
+    # How much of the bounding box the blob fills, relative to a disc (pi/4)
+    fill = largest / (stats[i + 1, cv2.CC_STAT_WIDTH] * stats[i + 1, cv2.CC_STAT_HEIGHT]) / (np.pi / 4)
+    return float(purity * min(fill, 1.0)), int(largest)
+
+
+def score_thresh(frames: List[np.ndarray], thresh: Tuple[cvtrack.HSV, cvtrack.HSV]) -> float:
+    t = cvtrack.generate_thresh(*thresh)
+    results = [score_frame(cvtrack.thresh_img(hsv, t)) for hsv in frames]
+    scores = np.array([s for s, _ in results])
+    areas = np.array([a for _, a in results], dtype=np.float64)
+    if not areas.all():
+        # Every frame must contain the target
+        return 0.0
+    # Penalize blobs that change size a lot between frames
+    stability = 1 - min(np.std(areas) / np.mean(areas), 1.0)
+    return float(np.mean(scores) * stability)
+
+
+def calibrate(frames: List[np.ndarray], seed: Tuple[cvtrack.HSV, cvtrack.HSV]) -> Tuple[Tuple[cvtrack.HSV, cvtrack.HSV], float]:
+    best = (seed, score_thresh(frames, seed))
+    for sat_low, val_low in itertools.product(SAT_LOWS, VAL_LOWS):
+        peak = find_peak(hue_histogram(frames, sat_low, val_low), hue_center(seed))
+        for width in HUE_WIDTHS:
+            thresh = (((peak - width) % 180, sat_low, val_low), ((peak + width) % 180, 255, 255))
+            score = score_thresh(frames, thresh)
+            if score > best[1]:
+                best = (thresh, score)
+    return best
+
+
+@click.command()
+@click.argument("vid_name", type=click.Path(exists=True, readable=True))
+@click.option("--samples", "-n", type=click.IntRange(min=2), default=24, help="Number of frames to sample across the video")
+@click.option("--scale", type=click.FloatRange(min=0, min_open=True, max=1), default=0.5, help="Downscale sampled frames by this factor")
+@click.option("--processes", "-j", type=click.IntRange(min=1), default=None, help="Number of decoding processes (default: CPU count)")
+@click.option("--min-confidence", type=click.FloatRange(min=0, max=1), default=0.5, help="Exit with an error if either target scores below this")
+def main(vid_name: str, samples: int, scale: float, processes: Optional[int], min_confidence: float) -> None:
+    """
+    Find HSV thresholds for the bob and pivot from frames sampled across VID_NAME.
+
+    The current thresholds in cvtrack are used as starting points, and the thresholds giving one compact blob of
+    stable size per target on every sampled frame are chosen.
+    """
+    cap = cv2.VideoCapture(vid_name)
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    if frame_count <= 0:
+        print(f"Error: Cannot determine the length of {vid_name}.")
+        sys.exit(1)
+    frame_nos = np.linspace(0, frame_count - 1, samples, dtype=int)
+    with multiprocessing.Pool(processes, initializer=_init_worker, initargs=(vid_name, scale)) as pool:
+        frames = [f for f in pool.map(_load_frame, frame_nos) if f is not None]
+    print(f"Sampled {len(frames)} frames")
+
+    ok = True
+    for name, seed in (("BOB_THRESH", cvtrack.BOB_THRESH), ("PIVOT_THRESH", cvtrack.PIVOT_THRESH)):
+        thresh, confidence = calibrate(frames, seed)
+        print(f"{name} = {thresh}")
+        print(f"Confidence: {confidence:.3f}")
+        ok = ok and confidence >= min_confidence
+    if not ok:
+        print("Error: Could not find reliable thresholds. Check the footage or adjust them with thresh_finder.py.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1 @@
+../framecache.py
\ No newline at end of file
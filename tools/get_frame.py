@@ -1,9 +1,11 @@
 import cv2
+import vidindex
 from sys import argv
 
 time = int(argv[2])
 
-cap = cv2.VideoCapture(argv[1])
+# Use the frame index if there is one, since plain seeking can land on the wrong frame
+cap = vidindex.open_video(argv[1])
 cap.set(cv2.CAP_PROP_POS_MSEC, time)
 _, img = cap.read()
 cv2.imwrite("frame.png", img)
@@ -0,0 +1 @@
+../lab2/spectral.py
\ No newline at end of file
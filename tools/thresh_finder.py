@@ -1,8 +1,10 @@
+import time
 import cv2
 import click
 import cvtrack
+import framecache
 import numpy as np
-from typing import List
+from typing import Dict, List, Optional, Tuple
 
 
 @click.command()
@@ -11,37 +13,72 @@ from typing import List
 @click.option("--bob-thresh-high", nargs=3, type=int, default=cvtrack.BOB_THRESH[1])
 @click.option("--pivot-thresh-low", nargs=3, type=int, default=cvtrack.PIVOT_THRESH[0])
 @click.option("--pivot-thresh-high", nargs=3, type=int, default=cvtrack.PIVOT_THRESH[1])
-def main(img: str, bob_thresh_low: cvtrack.HSV, bob_thresh_high: cvtrack.HSV, pivot_thresh_low: cvtrack.HSV, pivot_thresh_high: cvtrack.HSV) -> None:
+@click.option("--scale", type=click.FloatRange(min=0, min_open=True, max=1), default=None, help="Downscale the preview by this factor")
+@click.option("--time", "-t", "time_ms", type=float, default=0, help="If IMG is a video, the time in ms of the frame to use")
+@click.option("--cache/--no-cache", default=False, help="If IMG is a video, read it through the frame cache")
+@click.option("--debounce", type=click.IntRange(min=0), default=50, help="Milliseconds without slider movement before redrawing")
+def main(img: str, bob_thresh_low: cvtrack.HSV, bob_thresh_high: cvtrack.HSV, pivot_thresh_low: cvtrack.HSV, pivot_thresh_high: cvtrack.HSV,
+         scale: Optional[float], time_ms: float, cache: bool, debounce: int) -> None:
     blow = [i for i in bob_thresh_low]
     bhigh = [i for i in bob_thresh_high]
     plow = [i for i in pivot_thresh_low]
     phigh = [i for i in pivot_thresh_high]
-    img = cv2.imread(img)
+    img_name = img
+    img = cv2.imread(img_name)
+    if img is None:
+        # Not an image, so take a frame from the video instead
+        cap = framecache.open_video(img_name, cache)
+        cap.set(cv2.CAP_PROP_POS_MSEC, time_ms)
+        _, img = cap.read()
+        if img is None:
+            raise click.BadParameter(f"Cannot read an image or video frame from {img_name}", param_hint="IMG")
+    if scale is not None:
+        img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    # The image never changes, so only the thresholding has to be redone when a slider moves
+    hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
+
+    targets = {
+        "Bob": (blow, bhigh),
+        "Pivot": (plow, phigh),
+    } # type: Dict[str, Tuple[List[int], List[int]]]
+    centers = {} # type: Dict[str, Tuple[Optional[int], Optional[int]]]
+    # Targets whose sliders moved since the last redraw, and when the last move happened
+    dirty = set(targets)
+    last_change = 0.0
+
+    def update_target(name: str) -> None:
+        low, high = targets[name]
+        binary = cvtrack.thresh_img(hsv, cvtrack.generate_thresh(tuple(low), tuple(high)))
+        centers[name] = cvtrack.largest_blob(img, binary, raise_on_fail=False)
+        cv2.imshow(name, binary)
 
     def show_imgs() -> None:
-        print(blow, bhigh, plow, phigh)
-        ((x, y), (pivot_x, pivot_y)), (bb, pb) = cvtrack.process_img(img,
-            bob_thresh=(tuple(blow), tuple(bhigh)), pivot_thresh=(tuple(plow), tuple(phigh)),
-            raise_on_fail=False)
+        for name in dirty:
+            update_target(name)
+        dirty.clear()
         img2 = np.copy(img)
+        x, y = centers["Bob"]
         if x is not None and y is not None:
             cv2.circle(img2, (x, y), 3, (0, 255, 0), thickness=cv2.FILLED)
+        pivot_x, pivot_y = centers["Pivot"]
         if pivot_x is not None and pivot_y is not None:
             cv2.circle(img2, (pivot_x, pivot_y), 3, (0, 0, 255), thickness=cv2.FILLED)
         cv2.imshow("Image", img2)
-        cv2.imshow("Bob", bb)
-        cv2.imshow("Pivot", pb)
-    
+
     show_imgs()
     callbacks = []
-    for color in (blow, bhigh, plow, phigh):
-        cb = []
-        for i in range(3):
-            def _on_change(val: int, color=color, i=i):
-                color[i] = val
-                show_imgs()
-            cb.append(_on_change)
-        callbacks.append(cb)
+    for name, (low, high) in targets.items():
+        for color in (low, high):
+            cb = []
+            for i in range(3):
+                # Only record the change here; slider drags fire many callbacks which are coalesced into one redraw
+                def _on_change(val: int, name=name, color=color, i=i):
+                    nonlocal last_change
+                    color[i] = val
+                    dirty.add(name)
+                    last_change = time.monotonic()
+                cb.append(_on_change)
+            callbacks.append(cb)
     cv2.createTrackbar("Bob Hue (Low)", "Bob", blow[0], 180, callbacks[0][0])
     cv2.createTrackbar("Bob Hue (High)", "Bob", bhigh[0], 180, callbacks[1][0])
     cv2.createTrackbar("Bob Saturation (Low)", "Bob", blow[1], 180, callbacks[0][1])
@@ -56,7 +93,7 @@ def main(img: str, bob_thresh_low: cvtrack.HSV, bob_thresh_high: cvtrack.HSV, pi
     cv2.createTrackbar("Pivot Value (High)", "Pivot", phigh[2], 180, callbacks[3][2])
 
     while True:
-        k = cv2.waitKey(100)
+        k = cv2.waitKey(20)
         if k == ord("q"):
             break
         if cv2.getWindowProperty("Image", cv2.WND_PROP_VISIBLE) < 1:
@@ -65,7 +102,11 @@ def main(img: str, bob_thresh_low: cvtrack.HSV, bob_thresh_high: cvtrack.HSV, pi
             break
         if cv2.getWindowProperty("Bob", cv2.WND_PROP_VISIBLE) < 1:
             break
+        if dirty and (time.monotonic() - last_change) * 1000 >= debounce:
+            show_imgs()
     cv2.destroyAllWindows()
+    print("Bob:", (tuple(blow), tuple(bhigh)))
+    print("Pivot:", (tuple(plow), tuple(phigh)))
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,215 @@
+"""
+Frame index sidecar files for exact and fast seeking.
+
+The index records the presentation timestamp of every frame and which frames are keyframes, and is stored next to
+the video as <video>.idx.npz. Seeks jump to the nearest keyframe at or before the target and decode forward, and
+timestamps are looked up in the index instead of queried from the decoder.
+"""
+import argparse
+import pathlib
+from typing import List, Optional, Union
+
+import cv2
+import numpy as np
+
+
+class FrameIndex:
+
+    def __init__(self, times: np.ndarray, keyframes: np.ndarray, has_keyframes: bool):
+        # Presentation timestamp of every frame in ms, in presentation order
+        self.times = times
+        # Frame numbers of keyframes, sorted
+        self.keyframes = keyframes
+        # False if the backend couldn't tell us which frames are keyframes
+        self.has_keyframes = has_keyframes
+
+    def __len__(self) -> int:
+        return len(self.times)
+
+    def frame_at(self, ms: float) -> int:
+        """
+        Return the first frame at or after a time in ms.
+        """
+        # Small tolerance so that a frame's own (rounded) timestamp maps back to it
+        return int(np.searchsorted(self.times, ms - 1e-3))
+
+    def keyframe_before(self, frame: int) -> int:
+        if not self.has_keyframes:
+            return frame
+        i = np.searchsorted(self.keyframes, frame, side="right") - 1
+        return int(self.keyframes[max(i, 0)])
+
+    def save(self, path: pathlib.Path, video: pathlib.Path) -> None:
+        stat = video.stat()
+        with open(path, "wb") as f:
+            np.savez(f, times=self.times, keyframes=self.keyframes, has_keyframes=self.has_keyframes,
+                     size=stat.st_size, mtime=stat.st_mtime)
+
+    @classmethod
+    def load(cls, path: pathlib.Path, video: pathlib.Path) -> Optional["FrameIndex"]:
+        """
+        Load an index, or return None if it doesn't exist or the video changed since it was built.
+        """
+        if not path.exists():
+            return None
+        data = np.load(path)
+        stat = video.stat()
+        if int(data["size"]) != stat.st_size or float(data["mtime"]) != stat.st_mtime:
+            return None
+        return cls(data["times"], data["keyframes"], bool(data["has_keyframes"]))
+
+
+def index_path(video: Union[str, pathlib.Path]) -> pathlib.Path:
+    video = pathlib.Path(video)
+    return video.with_name(video.name + ".idx.npz")
+
+
+def build_index(video: Union[str, pathlib.Path]) -> FrameIndex:
+    # In raw mode FFmpeg returns packets without decoding them, which is much faster and tells us the keyframes
+    cap = cv2.VideoCapture(str(video), cv2.CAP_FFMPEG, [cv2.CAP_PROP_FORMAT, -1])
+    raw = cap.isOpened() and cap.get(cv2.CAP_PROP_FORMAT) == -1
+    if not raw:
+        cap = cv2.VideoCapture(str(video))
+    if not cap.isOpened():
+        raise ValueError(f"Cannot open video {video}")
+    fps = cap.get(cv2.CAP_PROP_FPS) or 30
+    times = []
+    keys = []
+    while cap.grab():
+        ms = cap.get(cv2.CAP_PROP_POS_MSEC)
+        # At the end of some videos the time reads zero; assume those frames follow on at the frame rate
+        if times and ms == 0:
+            ms = times[-1] + 1000 / fps
+        times.append(ms)
+        keys.append(raw and cap.get(cv2.CAP_PROP_LRF_HAS_KEY_FRAME) != 0)
+    cap.release()
+    times = np.array(times)
+    keys = np.array(keys, dtype=bool)
+    # Packets come in decode order, which differs from presentation order when there are B-frames
+    order = np.argsort(times, kind="stable")
+    keyframes = np.flatnonzero(keys[order])
+    return FrameIndex(times[order], keyframes, raw and len(keyframes) > 0)
+
+
+def load_or_build(video: Union[str, pathlib.Path], build: bool = True) -> Optional[FrameIndex]:
+    video = pathlib.Path(video)
+    if not video.exists():
+        return None
+    path = index_path(video)
+    index = FrameIndex.load(path, video)
+    if index is None and build:
+        index = build_index(video)
+        index.save(path, video)
+    return index
+
+
+class IndexedCapture:
+    """
+    Wrapper around cv2.VideoCapture which seeks exactly using a frame index and reports timestamps from it.
+
+    Supports the subset of the VideoCapture interface used by the tracking scripts.
+    """
+
+    def __init__(self, video: Union[str, pathlib.Path], index: FrameIndex):
+        self.cap = cv2.VideoCapture(str(video))
+        self.index = index
+        # Next frame to be returned by read()
+        self.next_frame = 0
+        # Whether the next frame has already been grabbed while seeking
+        self._grabbed = False
+
+    def isOpened(self) -> bool: # pylint: disable=invalid-name
+        return self.cap.isOpened()
+
+    def release(self) -> None:
+        self.cap.release()
+
+    def seek(self, frame: int) -> bool:
+        """
+        Position the capture so that the next read() returns the given frame.
+        """
+        frame = min(max(frame, 0), len(self.index))
+        self.next_frame = frame
+        self._grabbed = False
+        if frame >= len(self.index):
+            return False
+        key = self.index.keyframe_before(frame)
+        while True:
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, key)
+            if not self.cap.grab():
+                return False
+            # Check where the decoder actually landed rather than trusting the seek
+            current = self.index.frame_at(self.cap.get(cv2.CAP_PROP_POS_MSEC))
+            if current <= frame or key == 0:
+                break
+            key = self.index.keyframe_before(key - 1)
+        while current < frame:
+            if not self.cap.grab():
+                return False
+            current += 1
+        self._grabbed = True
+        return True
+
+    def grab(self) -> bool:
+        if self._grabbed:
+            self._grabbed = False
+            success = True
+        else:
+            success = self.cap.grab()
+        if success:
+            self.next_frame += 1
+        return success
+
+    def read(self, image: np.ndarray = None):
+        if not self.grab():
+            return False, None
+        return self.cap.retrieve(image)
+
+    def get(self, prop: int) -> float:
+        if prop == cv2.CAP_PROP_POS_MSEC:
+            # Timestamp of the last frame read, like VideoCapture
+            return float(self.index.times[self.next_frame - 1]) if 0 < self.next_frame <= len(self.index) else 0.0
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            return float(self.next_frame)
+        if prop == cv2.CAP_PROP_FRAME_COUNT:
+            return float(len(self.index))
+        return self.cap.get(prop)
+
+    def set(self, prop: int, value: float) -> bool:
+        if prop == cv2.CAP_PROP_POS_MSEC:
+            return self.seek(self.index.frame_at(value))
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            return self.seek(int(value))
+        return self.cap.set(prop, value)
+
+
+def open_video(video: Union[str, pathlib.Path], use_index: Optional[bool] = None):
+    """
+    Open a video, using its frame index if use_index is True (building it if needed),
+    or if use_index is None and an up to date index already exists.
+    """
+    index = None
+    if use_index is None or use_index:
+        index = load_or_build(video, build=bool(use_index))
+    if index is None:
+        return cv2.VideoCapture(str(video))
+    return IndexedCapture(video, index)
+
+
+def main(videos: List[pathlib.Path], force: bool) -> None:
+    for video in videos:
+        path = index_path(video)
+        if not force and FrameIndex.load(path, video) is not None:
+            print(f"{video}: index is up to date")
+            continue
+        index = build_index(video)
+        index.save(path, video)
+        kind = f"{len(index.keyframes)} keyframes" if index.has_keyframes else "keyframes unknown"
+        print(f"{video}: indexed {len(index)} frames, {kind}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build frame index sidecar files for exact seeking")
+    parser.add_argument("videos", type=pathlib.Path, nargs="+")
+    parser.add_argument("--force", action="store_true", help="Rebuild indices that are already up to date")
+    main(**vars(parser.parse_args()))
@@ -0,0 +1,260 @@
+"""
+Resident worker which keeps NumPy, SciPy, OpenCV and matplotlib loaded for repeated analysis jobs.
+
+Jobs are JSON objects, one per line, sent over a Unix socket (or stdin with --stdio), and each gets one line of JSON
+back. They run concurrently in a fixed pool of processes which import the heavy modules once at startup:
+
+    {"type": "run", "script": path, "argv": [...], "cwd": dir}
+        Run a script as if from the command line. Its output is sent as it is printed, as
+        {"stream": "stdout" or "stderr", "data": text} lines before the result, which has the returncode.
+    {"type": "track", "video": path, "start": s, "stop": s, "skip_frames": n, "fx": ..., "fy": ..., "detector": ...,
+     "correction": path}
+        Track part of a video as gendata.py does. Returns the time and angle lists.
+    {"type": "ping"}
+
+Every result also has the time the job took ("elapsed"); a job that can't be run gets {"error": message}. With
+--stdio an "id" in the job is copied to its output and result lines, since jobs finish in any order.
+
+Scripts which call resident.forward() run here automatically when PHY180_WORKER is set to the socket path. Plots
+are drawn with the non-interactive Agg backend, so scripts which show figures are only forwarded when they would
+be headless anyway (see resident.forward).
+"""
+import argparse
+import concurrent.futures
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import runpy
+import signal
+import socketserver
+import sys
+import threading
+import time
+import traceback
+from typing import Callable, Optional, TextIO
+
+import cv2
+
+import cvtrack
+import gendata
+import resident
+
+# Modules imported by each worker process up front
+PRELOAD = ["scipy.optimize", "scipy.odr", "scipy.signal", "matplotlib.pyplot"]
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def _preload() -> None:
+    os.environ["MPLBACKEND"] = "Agg"
+    # Jobs must run here, not be forwarded back
+    os.environ.pop(resident.SOCKET_ENV, None)
+    for name in PRELOAD:
+        __import__(name)
+
+
+def _forget_modules(before: set) -> None:
+    """
+    Unload modules from this repo imported by a job, since each lab has its own modules with the same names
+    (e.g. fit).
+    """
+    for name in set(sys.modules) - before:
+        path = getattr(sys.modules[name], "__file__", None)
+        if path and os.path.abspath(path).startswith(REPO_DIR + os.sep):
+            del sys.modules[name]
+
+
+class _StreamWriter(io.TextIOBase):
+    """
+    Text stream which sends what is written to a queue as (name, text), in chunks at most interval seconds apart.
+    """
+
+    def __init__(self, queue, name: str, interval: float = 0.1) -> None:
+        super().__init__()
+        self.queue = queue
+        self.name = name
+        self.interval = interval
+        self.pending = [] # type: list
+        self.last = time.monotonic()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, s: str) -> int:
+        if not isinstance(s, str):
+            # Like any text stream; click relies on this to tell text from binary streams
+            raise TypeError(f"write() argument must be str, not {type(s).__name__}")
+        self.pending.append(s)
+        if time.monotonic() - self.last >= self.interval:
+            self.flush()
+        return len(s)
+
+    def flush(self) -> None:
+        if self.pending:
+            self.queue.put((self.name, "".join(self.pending)))
+            self.pending = []
+        self.last = time.monotonic()
+
+
+def run_script(script: str, argv: list, cwd: str, queue) -> dict:
+    """
+    Run a script as __main__, sending its output to queue as it is printed.
+    """
+    out = _StreamWriter(queue, "stdout")
+    err = _StreamWriter(queue, "stderr")
+    before = set(sys.modules)
+    old_argv, old_path, old_cwd = sys.argv, list(sys.path), os.getcwd()
+    returncode = 0
+    try:
+        os.chdir(cwd)
+        sys.argv = [script] + list(argv)
+        sys.path.insert(0, os.path.dirname(script))
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+            try:
+                runpy.run_path(script, run_name="__main__")
+            except SystemExit as e:
+                if isinstance(e.code, int) or e.code is None:
+                    returncode = e.code or 0
+                else:
+                    print(e.code, file=sys.stderr)
+                    returncode = 1
+            except Exception: # pylint: disable=broad-except
+                traceback.print_exc()
+                returncode = 1
+    finally:
+        sys.argv, sys.path[:] = old_argv, old_path
+        os.chdir(old_cwd)
+        out.flush()
+        err.flush()
+        sys.modules["matplotlib.pyplot"].close("all")
+        _forget_modules(before)
+    return {"returncode": returncode}
+
+
+def track_video(video: str, start: float = 0, stop: Optional[float] = None, skip_frames: int = 0, fx: Optional[float] = None,
+                fy: Optional[float] = None, detector: str = "contour", correction: Optional[str] = None) -> dict:
+    cap = cv2.VideoCapture(video)
+    if not cap.isOpened():
+        raise ValueError(f"Video file {video} not openable")
+    tracker = cvtrack.Tracker(fx=fx, fy=fy, detector=detector)
+    correction = cvtrack.Correction.load(correction) if correction is not None else None
+    segment = (start * 1000, stop * 1000 if stop is not None else float("inf"))
+    samples = [(t, a) for t, a in gendata.track_segments(cap, [segment], lambda: gendata.track(cap, tracker, skip_frames, correction)) if t != 0]
+    cap.release()
+    return {"time": [t for t, _ in samples], "angle": [a for _, a in samples]}
+
+
+def run_job(job: dict, queue) -> dict:
+    """
+    Run one job in a worker process, sending any output to queue.
+    """
+    start = time.perf_counter()
+    try:
+        kind = job.get("type")
+        if kind == "run":
+            result = run_script(job["script"], job.get("argv", []), job.get("cwd", os.getcwd()), queue)
+        elif kind == "track":
+            args = {k: v for k, v in job.items() if k not in ("type", "id")}
+            result = track_video(**args)
+        elif kind == "ping":
+            result = {"pid": os.getpid()}
+        else:
+            raise ValueError(f"Unknown job type {kind}")
+    except Exception as e: # pylint: disable=broad-except
+        result = {"error": f"{type(e).__name__}: {e}"}
+    result["elapsed"] = time.perf_counter() - start
+    return result
+
+
+def serve_job(pool: concurrent.futures.Executor, manager, line: str, send: Callable[[dict], None]) -> None:
+    """
+    Run the job on one line of input, passing its output and then its result to send as they come.
+    """
+    try:
+        job = json.loads(line)
+    except ValueError as e:
+        send({"error": f"Invalid job: {e}"})
+        return
+    queue = manager.Queue()
+    future = pool.submit(run_job, job, queue)
+    # Everything the job sends is queued before it returns, so this is always last
+    future.add_done_callback(lambda _: queue.put(None))
+    job_id = job.get("id") if isinstance(job, dict) else None
+    extra = {"id": job_id} if job_id is not None else {}
+    for stream, data in iter(queue.get, None):
+        send({"stream": stream, "data": data, **extra})
+    send({**future.result(), **extra})
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self) -> None:
+        for line in self.rfile:
+            if line.strip():
+                serve_job(self.server.pool, self.server.manager, line, self.send)
+
+    def send(self, message: dict) -> None:
+        self.wfile.write(json.dumps(message).encode("utf-8") + b"\n")
+        self.wfile.flush()
+
+
+class _Server(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path: str, pool: concurrent.futures.Executor, manager) -> None:
+        self.pool = pool
+        self.manager = manager
+        super().__init__(path, _Handler)
+
+
+def serve_stdio(pool: concurrent.futures.Executor, manager, file_in: TextIO, file_out: TextIO) -> None:
+    lock = threading.Lock()
+
+    def send(message: dict) -> None:
+        with lock:
+            file_out.write(json.dumps(message) + "\n")
+            file_out.flush()
+
+    threads = []
+    for line in file_in:
+        if line.strip():
+            thread = threading.Thread(target=serve_job, args=(pool, manager, line, send))
+            thread.start()
+            threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+
+def main(socket_path: Optional[str], stdio: bool, processes: Optional[int]) -> None:
+    processes = processes or os.cpu_count() or 1
+    with multiprocessing.Manager() as manager, concurrent.futures.ProcessPoolExecutor(processes, initializer=_preload) as pool:
+        # Start every process now rather than on the first jobs
+        concurrent.futures.wait([pool.submit(time.sleep, 0.1) for _ in range(processes)])
+        if stdio:
+            serve_stdio(pool, manager, sys.stdin, sys.stdout)
+            return
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        server = _Server(socket_path, pool, manager)
+        # Clean up the socket when stopped with kill too
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        print(f"Listening on {socket_path}; set {resident.SOCKET_ENV}={socket_path} to forward scripts here")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            os.unlink(socket_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run analysis jobs in a pool of processes with the heavy modules kept loaded.")
+    parser.add_argument("--socket", dest="socket_path", type=str, default=os.environ.get(resident.SOCKET_ENV), help=f"Unix socket to listen on (default: ${resident.SOCKET_ENV})")
+    parser.add_argument("--stdio", action="store_true", help="Read jobs from stdin and write results to stdout instead of listening on a socket")
+    parser.add_argument("--processes", "-j", type=int, default=None, help="Number of worker processes (default: one per CPU)")
+    args = parser.parse_args()
+    if not args.stdio and not args.socket_path:
+        parser.error(f"--socket or {resident.SOCKET_ENV} is required unless using --stdio")
+    main(**vars(args))